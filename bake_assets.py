@@ -0,0 +1,82 @@
+"""Pre-decode the game's images and sounds into one memory-mappable pack.
+
+    python bake_assets.py [output]
+
+The pack holds raw pixels and PCM, so at runtime load_image/load_sound map
+it instead of decoding PNG/JPEG/BMP/WAV files. Re-run after changing data/;
+until then the changed files are loaded directly, see AssetPack.
+Music is left out on purpose: AudioManager streams it from the MP3.
+"""
+import json
+import os
+import sys
+import pygame
+from engine import DATA_DIR, PACK_PATH, PACK_MAGIC, PACK_HEADER, PACK_VERSION, PACK_ALIGN, source_stamp
+from mygameslib import IMAGES_DICT, BACKDROP_IMAGE, LUCKY_BLOCK_IMAGE, JUMP_SOUND
+
+# chimp.py keeps its own asset names
+CHIMP_IMAGES = ['chimp.bmp', 'fist.bmp']
+CHIMP_SOUNDS = ['whiff.wav', 'punch.wav']
+
+
+def referenced_assets():
+    images = [filename for frames in IMAGES_DICT.values() for v in frames.values() for filename in v]
+    images += [BACKDROP_IMAGE, LUCKY_BLOCK_IMAGE] + CHIMP_IMAGES
+    sounds = [JUMP_SOUND] + CHIMP_SOUNDS
+    return list(dict.fromkeys(images)), sounds
+
+
+def _decode_image(path):
+    image = pygame.image.load(path)
+    fmt = 'RGBA' if image.get_flags() & pygame.SRCALPHA else 'RGB'
+    return {'kind': 'image', 'size': list(image.get_size()), 'format': fmt}, pygame.image.tobytes(image, fmt)
+
+
+def _decode_sound(path):
+    sound = pygame.mixer.Sound(path)
+    return {'kind': 'sound', 'mixer': list(pygame.mixer.get_init())}, sound.get_raw()
+
+
+def bake(output=PACK_PATH, source_dir=DATA_DIR):
+    images, sounds = referenced_assets()
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    pygame.mixer.init()
+
+    index = {}
+    blobs = []
+    for names, decode in ((images, _decode_image), (sounds, _decode_sound)):
+        for name in names:
+            path = os.path.join(source_dir, name)
+            if not os.path.exists(path):
+                print('Skipping missing asset:', name)
+                continue
+            entry, data = decode(path)
+            entry['length'] = len(data)
+            entry['source'] = source_stamp(name, source_dir)
+            index[name] = entry
+            blobs.append((name, data))
+
+    # blob offsets are relative to the aligned data section following the index
+    position = 0
+    for name, data in blobs:
+        position += -position % PACK_ALIGN
+        index[name]['offset'] = position
+        position += len(data)
+    encoded = json.dumps(index, sort_keys=True).encode('utf-8')
+    data_start = PACK_HEADER.size + len(encoded)
+    data_start += -data_start % PACK_ALIGN
+
+    with open(output, 'wb') as f:
+        f.write(PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, len(encoded)))
+        f.write(encoded)
+        for name, data in blobs:
+            f.seek(data_start + index[name]['offset'])
+            f.write(data)
+
+    pygame.mixer.quit()
+    return index
+
+
+if __name__ == '__main__':
+    index = bake(*sys.argv[1:2])
+    print('Baked %d assets into %s' % (len(index), sys.argv[1] if len(sys.argv) > 1 else PACK_PATH))
@@ -0,0 +1,112 @@
+"""Run many headless game sessions in parallel, e.g. for physics tuning sweeps.
+
+    python batch.py --seeds 8 --frames 3000
+    python batch.py --running-speed 3 4 5 --jumping-speed 18 20 22 --gravity 1 2
+    python batch.py --replay run.rec --running-speed 3 4 5 --workers 4
+
+Every combination of the swept parameters is run once per seed (random
+inputs) or once per replay file. Jobs are spread over a process pool, one
+worker per core by default, and each reports frames simulated, Mario's
+final position and the number of collisions resolved. Results are printed
+as JSON lines.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import sys
+from concurrent.futures import ProcessPoolExecutor
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+from mygameslib import Game, Action, ReplayDriver, GRAVITY, DEFAULT_LEVEL
+
+# weights for the random input scripts; None means no new input
+SCRIPT_ACTIONS = ((Action.RIGHT, 6), (Action.LEFT, 2), (Action.JUMP, 3), (Action.STOP, 2), (None, 3))
+
+
+def random_script(seed, frames):
+    """(actions, n_frames) steps adding up to frames, reproducible from seed."""
+    rng = random.Random(seed)
+    actions, weights = zip(*SCRIPT_ACTIONS)
+    script = []
+    left = frames
+    while left > 0:
+        action = rng.choices(actions, weights)[0]
+        n = min(left, rng.randint(1, 30))
+        script.append(([action] if action is not None else [], n))
+        left -= n
+    return script
+
+
+def simulate(job):
+    """Run one session described by a job dict and return its results.
+
+    Recognised keys are seed, frames, replay (a replay file to play instead
+    of random inputs), running_speed, jumping_speed, gravity and level.
+    """
+    game = Game(headless=True, level=job.get('level', DEFAULT_LEVEL))
+    mario = game.mario
+    mario.running_speed = job.get('running_speed', mario.running_speed)
+    mario.jumping_speed = job.get('jumping_speed', mario.jumping_speed)
+    mario.acceleration = (0, job.get('gravity', GRAVITY))
+    if job.get('replay'):
+        ReplayDriver.load(job['replay']).play(game)
+    else:
+        for actions, n in random_script(job.get('seed', 0), job.get('frames', 1000)):
+            game.step(actions, n)
+    return dict(job, frames=game.frame, position=list(mario.rect.midbottom),
+                velocity=list(mario.velocity), camera=game.camera.x, collisions=game.collisions)
+
+
+def sweep(seeds=(0,), frames=1000, replays=(), **params):
+    """Jobs for every combination of the swept params, e.g. running_speed=(3, 4, 5).
+
+    Each combination runs once per replay file, or once per seed when no
+    replays are given.
+    """
+    names = sorted(params)
+    runs = [{'replay': path} for path in replays] or [{'seed': seed, 'frames': frames} for seed in seeds]
+    for values in itertools.product(*(params[name] for name in names)):
+        for run in runs:
+            yield dict(run, **dict(zip(names, values)))
+
+
+def run_batch(jobs, workers=None):
+    """Simulate jobs over a pool of worker processes; results come back in job order.
+
+    Workers are spawned rather than forked so none of them inherits the
+    parent's SDL state.
+    """
+    jobs = list(jobs)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        return [simulate(job) for job in jobs]
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers, mp_context=context) as pool:
+        return list(pool.map(simulate, jobs, chunksize=max(1, len(jobs) // (4 * workers))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seeds', type=int, default=1, help='random input scripts per combination')
+    parser.add_argument('--frames', type=int, default=1000, help='frames per random session')
+    parser.add_argument('--replay', nargs='+', default=(), metavar='PATH',
+                        help='play these recordings instead of random inputs')
+    parser.add_argument('--running-speed', type=int, nargs='+')
+    parser.add_argument('--jumping-speed', type=int, nargs='+')
+    parser.add_argument('--gravity', type=int, nargs='+')
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per core)')
+    args = parser.parse_args(argv)
+
+    params = {name: getattr(args, name) for name in ('running_speed', 'jumping_speed', 'gravity')
+              if getattr(args, name)}
+    jobs = sweep(range(args.seeds), args.frames, args.replay, **params)
+    for result in run_batch(jobs, args.workers):
+        print(json.dumps(result))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
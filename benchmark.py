@@ -0,0 +1,363 @@
+"""Benchmarks for the sprite, physics and rendering hot paths.
+
+    python benchmark.py                          run the suite and print throughput
+    python benchmark.py --save baseline.json     ... and record it as a baseline
+    python benchmark.py --baseline baseline.json [--threshold 0.2]
+                                                 fail if anything got slower than that
+    python benchmark.py --compare                old vs new implementation comparisons and
+                                                 per-entity memory footprint
+
+Everything runs headless on the SDL dummy drivers. Throughput is reported in
+operations (updates, flips, loads, frames...) per second; higher is better.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+import pygame
+from PIL import Image
+from mygameslib import (SpatialHash, PhysicsBatch, Mario, Game, Action, LevelBackdrop, LuckyBlock,
+                        BlockEntity, CharacterEntity, GROUND_LEVEL, DATA_DIR, load_image,
+                        repeat_surface, pixels_overlap)
+
+SCALES = (1, 100, 1000)
+
+
+class _Block:
+    def __init__(self, rect):
+        self.rect = rect
+
+
+def _make_level(n_blocks, seed=0):
+    rng = random.Random(seed)
+    blocks = [_Block(pygame.Rect(rng.randrange(0, 40 * n_blocks), rng.randrange(0, 300), 39, 39))
+              for _ in range(n_blocks)]
+    movers = [pygame.Rect(rng.randrange(0, 40 * n_blocks), rng.randrange(0, 300), 34, 66)
+              for _ in range(100)]
+    return blocks, movers
+
+
+def bench_collision(n_blocks=1000, repeat=5):
+    """Seconds per frame for 100 moving rects against n_blocks solids, brute force vs spatial hash."""
+    blocks, movers = _make_level(n_blocks)
+    grid = SpatialHash()
+    for block in blocks:
+        grid.insert(block)
+
+    def brute_force():
+        hits = 0
+        for rect in movers:
+            for block in blocks:
+                if rect.colliderect(block.rect):
+                    hits += 1
+        return hits
+
+    def spatial_hash():
+        hits = 0
+        for rect in movers:
+            for block in grid.query(rect):
+                if rect.colliderect(block.rect):
+                    hits += 1
+        return hits
+
+    assert brute_force() == spatial_hash()
+    return {'brute_force': min(timeit.repeat(brute_force, number=1, repeat=repeat)),
+            'spatial_hash': min(timeit.repeat(spatial_hash, number=1, repeat=repeat)),
+            }
+
+
+def bench_physics(n_characters=1000, frames=60):
+    """Seconds per frame integrating n_characters one by one vs through a PhysicsBatch.
+
+    batched_view only writes back the rects inside a view a tenth as wide as the crowd.
+    """
+    if pygame.display.get_surface() is None:
+        pygame.display.set_mode((600, 337))
+
+    def crowd():
+        marios = [Mario((i % 600, GROUND_LEVEL)) for i in range(n_characters)]
+        for i, mario in enumerate(marios):
+            mario.run(1 if i % 2 else -1)
+            if i % 3 == 0:
+                mario.jump()
+        return marios
+
+    marios = crowd()
+
+    def per_sprite():
+        for _ in range(frames):
+            for mario in marios:
+                mario._update_vectors()
+                if mario.rect.bottom > GROUND_LEVEL:
+                    mario.rect.bottom = GROUND_LEVEL
+                    mario.velocity[1] = 0
+                mario._update_state()
+
+    batch = PhysicsBatch(capacity=n_characters)
+    for mario in crowd():
+        batch.add(mario)
+
+    def batched():
+        for _ in range(frames):
+            batch.step()
+
+    view = pygame.Rect(0, 0, 60, 337)  # a tenth of the crowd's spread
+
+    def batched_view():
+        for _ in range(frames):
+            batch.step(view)
+
+    return {'per_sprite': min(timeit.repeat(per_sprite, number=1, repeat=3)) / frames,
+            'batched': min(timeit.repeat(batched, number=1, repeat=3)) / frames,
+            'batched_view': min(timeit.repeat(batched_view, number=1, repeat=3)) / frames,
+            }
+
+
+def bench_backdrop_load(nrepeat=2, repeat=5):
+    """Seconds to build a repeated backdrop through PIL paste/tobytes/fromstring vs repeat_surface."""
+    if pygame.display.get_surface() is None:
+        pygame.display.set_mode((600, 337))
+    path = os.path.join(DATA_DIR, 'supermariobackground.jpg')
+
+    def through_pil():
+        image = Image.open(path)
+        width, height = image.size
+        new_im = Image.new(image.mode, (width * nrepeat, height))
+        for i in range(nrepeat):
+            new_im.paste(image, (i * width, 0))
+        return pygame.image.fromstring(new_im.tobytes(), new_im.size, new_im.mode).convert()
+
+    def through_pygame():
+        return repeat_surface(pygame.image.load(path).convert(), nrepeat)
+
+    return {'pil': min(timeit.repeat(through_pil, number=1, repeat=repeat)),
+            'pygame': min(timeit.repeat(through_pygame, number=1, repeat=repeat)),
+            }
+
+
+def _mask_pairs(n=100):
+    """n Mario/block pairs whose rects overlap, cycling through animation frames."""
+    _display()
+    pairs = []
+    for i in range(n):
+        mario = Mario((100, 200))
+        mario.run(1 if i % 2 else -1)
+        for _ in range(i % 6):
+            mario.update()
+        block = LuckyBlock()
+        block.rect.center = mario.rect.move(i % 30 - 15, i % 40 - 20).center
+        pairs.append((mario, block))
+    return pairs
+
+
+def bench_masks(n=100, repeat=5):
+    """Seconds per frame for n pixel tests: masks cached per frame vs built on demand."""
+    pairs = _mask_pairs(n)
+    from_surface = pygame.mask.from_surface
+
+    def cached():
+        return sum(pixels_overlap(mario, block) for mario, block in pairs)
+
+    def on_demand():
+        hits = 0
+        for mario, block in pairs:
+            offset = (block.rect.x - mario.rect.x, block.rect.y - mario.rect.y)
+            hits += from_surface(mario.image).overlap(from_surface(block.image), offset) is not None
+        return hits
+
+    assert cached() == on_demand()
+    return {'cached': min(timeit.repeat(cached, number=1, repeat=repeat)),
+            'on_demand': min(timeit.repeat(on_demand, number=1, repeat=repeat)),
+            }
+
+
+def _throughput(func, ops, repeat=3):
+    """Best-of-repeat operations per second, where one func() call does ops operations."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return ops * number / min(timer.repeat(repeat=repeat, number=number))
+
+
+def _display():
+    if pygame.display.get_surface() is None:
+        pygame.display.set_mode((600, 337))
+
+
+def bench_mario_update(n):
+    """Mario.update plus the landing on the ground a Game does, so nobody falls forever."""
+    _display()
+    marios = [Mario((50 + i % 500, GROUND_LEVEL)) for i in range(n)]
+    for i, mario in enumerate(marios):
+        mario.run(1 if i % 2 else -1)
+
+    def update():
+        for mario in marios:
+            mario.update()
+            if mario.rect.bottom > GROUND_LEVEL:
+                mario.rect.bottom = GROUND_LEVEL
+                mario.velocity[1] = 0
+    return _throughput(update, n)
+
+
+def bench_direction_flip():
+    _display()
+    mario = Mario((50, GROUND_LEVEL))
+
+    def flip():
+        mario.direction = -mario.direction
+    return _throughput(flip, 1)
+
+
+def bench_load_image():
+    _display()
+    return _throughput(lambda: load_image('mario1.png', -1), 1)
+
+
+def bench_level_backdrop():
+    _display()
+    return _throughput(LevelBackdrop, 1)
+
+
+def _crowded_game(n_characters=0, n_blocks=0):
+    game = Game(headless=True)
+    extras = [Mario((50 + 7 * i % 500, GROUND_LEVEL)) for i in range(n_characters - 1)]
+    for i, mario in enumerate(extras):
+        mario.run(1 if i % 2 else -1)
+    game.allsprites.add_world(*extras, dynamic=True)
+    for i in range(n_blocks):
+        block = LuckyBlock()
+        block.rect.midbottom = (400 + 45 * i, 210 - 60 * (i % 2))
+        game.solids.insert(block)
+    return game, extras
+
+
+def bench_mask_collision():
+    pairs = _mask_pairs()
+    return _throughput(lambda: [pixels_overlap(mario, block) for mario, block in pairs], len(pairs))
+
+
+def bench_collision_block(n):
+    game, _ = _crowded_game(n_blocks=n)
+    game.mario.rect.midbottom = (300, 170)
+    game.mario.velocity[:] = [4, 10]
+    return _throughput(lambda: game._collide(game.mario), 1)
+
+
+def bench_game_frame(n):
+    game, extras = _crowded_game(n_characters=n)
+    game.step([Action.RIGHT])
+
+    def frame():
+        game.step()
+        for mario in extras:
+            game._collide(mario)
+        game.render()
+    return _throughput(frame, 1)
+
+
+def run_suite():
+    results = {}
+    for n in SCALES:
+        results['mario_update_%d' % n] = bench_mario_update(n)
+    results['direction_flip'] = bench_direction_flip()
+    results['load_image'] = bench_load_image()
+    results['level_backdrop'] = bench_level_backdrop()
+    results['mask_collision'] = bench_mask_collision()
+    for n in SCALES:
+        results['collision_block_%d' % n] = bench_collision_block(n)
+    for n in SCALES:
+        results['game_frame_%d' % n] = bench_game_frame(n)
+    pygame.quit()
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold=0.2):
+    """Names of the benchmarks whose throughput fell more than threshold below baseline."""
+    return [name for name, rate in sorted(results.items())
+            if name in baseline and rate < baseline[name] * (1 - threshold)]
+
+
+def bench_memory(n=10000):
+    """Bytes allocated per instance for sprite- and entity-based blocks and characters."""
+    _display()
+    factories = {'LuckyBlock sprite': LuckyBlock,
+                 'BlockEntity': lambda: BlockEntity((300, 210)),
+                 'Mario sprite': lambda: Mario((50, GROUND_LEVEL)),
+                 'CharacterEntity': lambda: CharacterEntity((50, GROUND_LEVEL)),
+                 }
+    footprint = {}
+    for name, factory in factories.items():
+        factory()  # warm the shared image caches first
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        instances = [factory() for _ in range(n)]
+        footprint[name] = (tracemalloc.get_traced_memory()[0] - before) / n
+        tracemalloc.stop()
+        del instances
+    return footprint
+
+
+def run_comparisons():
+    for n in (10, 100, 1000, 10000):
+        result = bench_collision(n)
+        print('%6d blocks: brute force %8.3f ms, spatial hash %8.3f ms' %
+              (n, result['brute_force'] * 1000, result['spatial_hash'] * 1000))
+    for n in (1, 100, 1000):
+        result = bench_physics(n)
+        print('%6d characters: per sprite %8.3f ms, batched %8.3f ms, batched in view %8.3f ms' %
+              (n, result['per_sprite'] * 1000, result['batched'] * 1000, result['batched_view'] * 1000))
+    for n in (2, 8):
+        result = bench_backdrop_load(n)
+        print('%6dx backdrop: PIL %8.3f ms, repeat_surface %8.3f ms' %
+              (n, result['pil'] * 1000, result['pygame'] * 1000))
+    for n in (10, 100, 1000):
+        result = bench_masks(n)
+        print('%6d mask tests: cached %8.3f ms, on demand %8.3f ms' %
+              (n, result['cached'] * 1000, result['on_demand'] * 1000))
+    for name, size in bench_memory().items():
+        print('%-18s %8.0f bytes per instance' % (name, size))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--save', metavar='PATH', help='write the results as a JSON baseline')
+    parser.add_argument('--baseline', metavar='PATH', help='JSON baseline to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed fractional slowdown against the baseline (default 0.2)')
+    parser.add_argument('--compare', action='store_true',
+                        help='run the old vs new implementation comparisons instead')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        run_comparisons()
+        return 0
+
+    results = run_suite()
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    for name, rate in results.items():
+        line = '%-22s %14.1f /s' % (name, rate)
+        if name in baseline:
+            line += '  %+6.1f%%' % (100.0 * (rate / baseline[name] - 1))
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    regressions = compare_to_baseline(results, baseline, args.threshold)
+    if regressions:
+        print('Regressed by more than %d%%: %s' % (args.threshold * 100, ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,57 +6,24 @@ follow along in the tutorial.
 """
 
 # Import Modules
-import os, pygame
+import pygame
 from pygame.locals import *
-from pygame.compat import geterror
+from engine import load_asset_pack, load_image, load_sound, load_font, TRANSFORMS, Scene, GameLoop
 
 if not pygame.font:
     print('Warning, fonts disabled')
 if not pygame.mixer:
     print('Warning, sound disabled')
 
-main_dir = os.path.split(os.path.abspath(__file__))[0]
-data_dir = os.path.join(main_dir, 'data')
-
-
-# functions to create our resources
-def load_image(name, colorkey=None):
-    fullname = os.path.join(data_dir, name)
-    try:
-        image = pygame.image.load(fullname)
-    except pygame.error:
-        print('Cannot load image:', fullname)
-        raise SystemExit(str(geterror()))
-    image = image.convert()
-    if colorkey is not None:
-        if colorkey is -1:
-            colorkey = image.get_at((0, 0))
-        image.set_colorkey(colorkey, RLEACCEL)
-    return image, image.get_rect()
-
-
-def load_sound(name):
-    class NoneSound:
-        def play(self): pass
-
-    if not pygame.mixer or not pygame.mixer.get_init():
-        return NoneSound()
-    fullname = os.path.join(data_dir, name)
-    try:
-        sound = pygame.mixer.Sound(fullname)
-    except pygame.error:
-        print('Cannot load sound: %s' % fullname)
-        raise SystemExit(str(geterror()))
-    return sound
-
-
-# classes for our game objects
+
+# classes for our game objects (images and sounds come from the engine's loaders)
 class Fist(pygame.sprite.Sprite):
     """moves a clenched fist on the screen, following the mouse"""
 
     def __init__(self):
         pygame.sprite.Sprite.__init__(self)  # call Sprite initializer
-        self.image, self.rect = load_image('fist.bmp', -1)
+        self.image = load_image('fist.bmp', -1)
+        self.rect = self.image.get_rect()
         self.punching = 0
 
     def update(self):
@@ -84,11 +51,14 @@ class Chimp(pygame.sprite.Sprite):
 
     def __init__(self):
         pygame.sprite.Sprite.__init__(self)  # call Sprite intializer
-        self.image, self.rect = load_image('chimp.bmp', -1)
+        self.source = load_image('chimp.bmp', -1)
+        self.image = self.source
+        self.rect = self.image.get_rect()
         screen = pygame.display.get_surface()
         self.area = screen.get_rect()
         self.rect.topleft = 10, 10
         self.move = 9
+        self.facing = 0  # 1 once flipped to walk the other way
         self.dizzy = 0
 
     def update(self):
@@ -105,20 +75,17 @@ class Chimp(pygame.sprite.Sprite):
                         self.rect.right > self.area.right:
             self.move = -self.move
             newpos = self.rect.move((self.move, 0))
-            self.image = pygame.transform.flip(self.image, 1, 0)
+            self.facing = 1 - self.facing
+            self.image = TRANSFORMS.flipped(self.source, self.facing)
         self.rect = newpos
 
     def _spin(self):
-        "spin the monkey image"
-        center = self.rect.center
-        self.dizzy = self.dizzy + 12
-        if self.dizzy >= 360:
-            self.dizzy = 0
-            self.image = self.original
-        else:
-            rotate = pygame.transform.rotate
-            self.image = rotate(self.original, self.dizzy)
-        self.rect = self.image.get_rect(center=center)
+        "spin the monkey image, one precomputed 12 degree step per frame"
+        rotations = TRANSFORMS.rotations(self.original)
+        # steps 1..29 are rotated, the last one shows the original again
+        self.image, offset = rotations[self.dizzy % len(rotations)]
+        self.rect = offset.move(self.rect.center)
+        self.dizzy = (self.dizzy + 1) % (len(rotations) + 1)
 
     def punched(self):
         "this will cause the monkey to start spinning"
@@ -127,66 +94,69 @@ class Chimp(pygame.sprite.Sprite):
             self.original = self.image
 
 
+class ChimpScene(Scene):
+    """the whole game: background, sprites and input handling,
+       run by the engine's fixed-timestep loop"""
+
+    def __init__(self, screen):
+        self.screen = screen
+
+        # Create The Backgound
+        self.background = pygame.Surface(screen.get_size())
+        self.background = self.background.convert()
+        self.background.fill((250, 250, 250))
+
+        # Put Text On The Background, Centered
+        font = load_font(None, 36)
+        if font is not None:
+            text = font.render("Pummel The Chimp, And Win $$$", 1, (10, 10, 10))
+            textpos = text.get_rect(centerx=self.background.get_width() / 2)
+            self.background.blit(text, textpos)
+
+        # Prepare Game Objects
+        self.whiff_sound = load_sound('whiff.wav')
+        self.punch_sound = load_sound('punch.wav')
+        self.chimp = Chimp()
+        self.fist = Fist()
+        self.allsprites = pygame.sprite.RenderPlain((self.fist, self.chimp))
+
+    def handle_event(self, event):
+        if event.type == QUIT:
+            self.running = False
+        elif event.type == KEYDOWN and event.key == K_ESCAPE:
+            self.running = False
+        elif event.type == MOUSEBUTTONDOWN:
+            if self.fist.punch(self.chimp):
+                self.punch_sound.play()  # punch
+                self.chimp.punched()
+            else:
+                self.whiff_sound.play()  # miss
+        elif event.type == MOUSEBUTTONUP:
+            self.fist.unpunch()
+
+    def update(self):
+        self.allsprites.update()
+
+    def draw(self, alpha):
+        # Draw Everything
+        self.screen.blit(self.background, (0, 0))
+        self.allsprites.draw(self.screen)
+        pygame.display.flip()
+
+
 def main():
     """this function is called when the program starts.
-       it initializes everything it needs, then runs in
-       a loop until the function returns."""
+       it initializes everything it needs, then hands the
+       scene to the engine loop until it stops running."""
     # Initialize Everything
     pygame.init()
     screen = pygame.display.set_mode((468, 60))
     pygame.display.set_caption('Monkey Fever')
     pygame.mouse.set_visible(0)
-
-    # Create The Backgound
-    background = pygame.Surface(screen.get_size())
-    background = background.convert()
-    background.fill((250, 250, 250))
-
-    # Put Text On The Background, Centered
-    if pygame.font:
-        font = pygame.font.Font(None, 36)
-        text = font.render("Pummel The Chimp, And Win $$$", 1, (10, 10, 10))
-        textpos = text.get_rect(centerx=background.get_width() / 2)
-        background.blit(text, textpos)
-
-    # Display The Background
-    screen.blit(background, (0, 0))
-    pygame.display.flip()
-
-    # Prepare Game Objects
-    clock = pygame.time.Clock()
-    whiff_sound = load_sound('whiff.wav')
-    punch_sound = load_sound('punch.wav')
-    chimp = Chimp()
-    fist = Fist()
-    allsprites = pygame.sprite.RenderPlain((fist, chimp))
+    load_asset_pack()  # pre-decoded images and sounds, if bake_assets.py was run
 
     # Main Loop
-    going = True
-    while going:
-        clock.tick(60)
-
-        # Handle Input Events
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                going = False
-            elif event.type == KEYDOWN and event.key == K_ESCAPE:
-                going = False
-            elif event.type == MOUSEBUTTONDOWN:
-                if fist.punch(chimp):
-                    punch_sound.play()  # punch
-                    chimp.punched()
-                else:
-                    whiff_sound.play()  # miss
-            elif event.type == MOUSEBUTTONUP:
-                fist.unpunch()
-
-        allsprites.update()
-
-        # Draw Everything
-        screen.blit(background, (0, 0))
-        allsprites.draw(screen)
-        pygame.display.flip()
+    GameLoop(ChimpScene(screen)).run()
 
     pygame.quit()
 
@@ -196,4 +166,4 @@ def main():
 
 # this calls the 'main' function when this script is executed
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,520 @@
+"""Engine core shared by the games: resources, a fixed-timestep loop and scenes.
+
+Loading goes through one set of helpers (asset pack, decode, convert,
+caches), so improvements there help every game built on it. Games plug in
+as Scene objects driven by GameLoop.
+"""
+import os
+import json
+import mmap
+import struct
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
+import pygame
+from profiling import startup_section, NullFrameProfiler
+
+MAIN_DIR = os.path.split(os.path.abspath(__file__))[0]
+DATA_DIR = os.path.join(MAIN_DIR, 'data')
+PACK_PATH = os.path.join(DATA_DIR, 'assets.pack')
+PACK_MAGIC = b'AGPK'
+PACK_HEADER = struct.Struct('<4sII')  # magic, version, index length
+PACK_VERSION = 2
+PACK_ALIGN = 16
+
+
+def source_stamp(name, source_dir=DATA_DIR):
+    """[mtime in ns, size] of a loose asset file, or None if it is missing."""
+    try:
+        st = os.stat(os.path.join(source_dir, name))
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+class AssetPack:
+    """Read-only, memory-mapped pack of pre-decoded images and sounds.
+
+    Written by bake_assets.py: a header, a JSON index and raw RGB(A) pixel
+    and PCM blobs. Surfaces and sounds are built straight from the mapped
+    bytes, so no PNG/JPEG/WAV decoding happens at runtime. The index records
+    each source file's stamp; entries whose loose file has changed since
+    baking are left out (and listed in stale), so those load from source_dir
+    until the pack is baked again.
+    """
+    def __init__(self, path=PACK_PATH, source_dir=DATA_DIR):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, index_length = PACK_HEADER.unpack_from(self._map)
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            raise ValueError('%s is not a version %d asset pack' % (path, PACK_VERSION))
+        start = PACK_HEADER.size
+        self.index = json.loads(bytes(self._map[start:start + index_length]).decode('utf-8'))
+        self._data_start = start + index_length
+        self._data_start += -self._data_start % PACK_ALIGN
+        self.stale = []
+        for name, entry in list(self.index.items()):
+            stamp = source_stamp(name, source_dir)
+            if stamp is not None and stamp != entry['source']:
+                self.stale.append(name)
+                del self.index[name]
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def _blob(self, entry):
+        offset = self._data_start + entry['offset']
+        return memoryview(self._map)[offset:offset + entry['length']]
+
+    def image(self, name):
+        """Unconverted surface viewing the mapped pixels; convert() before keeping it."""
+        entry = self.index[name]
+        return pygame.image.frombuffer(self._blob(entry), tuple(entry['size']), entry['format'])
+
+    def sound(self, name):
+        entry = self.index[name]
+        if pygame.mixer.get_init() != tuple(entry['mixer']):
+            return None  # baked for a different mixer format
+        return pygame.mixer.Sound(buffer=self._blob(entry))
+
+    def close(self):
+        self._map.close()
+
+
+ASSET_PACK = None
+
+
+def load_asset_pack(path=PACK_PATH):
+    """Map the baked asset pack, if there is one, and serve loads from it."""
+    global ASSET_PACK
+    if ASSET_PACK is None and os.path.exists(path):
+        try:
+            ASSET_PACK = AssetPack(path)
+        except ValueError as message:
+            print('Ignoring asset pack:', message)  # e.g. baked by an older version
+            return None
+        if ASSET_PACK.stale:
+            print('Asset pack out of date, loading from files:', ', '.join(ASSET_PACK.stale))
+    return ASSET_PACK
+
+
+def _decode_image(name):
+    """Unconverted surface for name; touches no display state, so any thread may call it."""
+    if ASSET_PACK is not None and name in ASSET_PACK:
+        return ASSET_PACK.image(name)
+    fullname = os.path.join(DATA_DIR, name)
+    try:
+        return pygame.image.load(fullname)
+    except pygame.error as message:
+        print('Cannot load image:', fullname)
+        raise SystemExit(message)
+
+
+def _finish_image(image, colorkey=None):
+    image = image.convert()
+    if colorkey is not None:
+        if colorkey == -1:
+            colorkey = image.get_at((0, 0))
+        image.set_colorkey(colorkey, pygame.RLEACCEL)
+    return image
+
+
+def load_image(name, colorkey=None):
+    return _finish_image(_decode_image(name), colorkey)
+
+
+def init_mixer():
+    """Initialise the mixer on first use rather than at startup."""
+    if not pygame.mixer:
+        return False
+    if not pygame.mixer.get_init():
+        try:
+            with startup_section('mixer init'):
+                pygame.mixer.init()
+        except pygame.error:
+            return False
+    return True
+
+
+_FONTS = {}
+
+
+def load_font(name=None, size=18):
+    if not pygame.font:
+        return None
+    if not pygame.font.get_init():
+        _FONTS.clear()  # fonts from before a pygame.quit() are dead
+        with startup_section('font init'):
+            pygame.font.init()
+    font = _FONTS.get((name, size))
+    if font is None:
+        font = _FONTS[(name, size)] = pygame.font.Font(name, size)
+    return font
+
+
+def load_sound(name):
+    class NoneSound:
+        def play(self): pass
+
+    if not init_mixer():
+        return NoneSound()
+    if ASSET_PACK is not None and name in ASSET_PACK:
+        sound = ASSET_PACK.sound(name)
+        if sound is not None:
+            return sound
+    fullname = os.path.join(DATA_DIR, name)
+
+    sound = pygame.mixer.Sound(fullname)
+
+    return sound
+
+
+class AssetCache:
+    """Process-wide LRU cache of decoded and converted surfaces.
+
+    Entries are keyed by (filename, colorkey, style) and evicted least recently
+    used first once either max_entries or max_bytes is exceeded. The surfaces
+    handed out are shared, so callers must copy before drawing onto them.
+    """
+    def __init__(self, max_entries=256, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, loader):
+        asset = self._entries.get(key)
+        if asset is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return asset
+
+        self.misses += 1
+        with startup_section('load %s' % (key[0],)):
+            asset = loader()
+        self._entries[key] = asset
+        self.nbytes += self._asset_size(asset)
+        self._evict()
+        return asset
+
+    def get_image(self, name, colorkey=None, style=None):
+        return self.get((name, colorkey, style), lambda: load_image(name, colorkey))
+
+    def _evict(self):
+        while len(self._entries) > 1 and (
+                (self.max_entries is not None and len(self._entries) > self.max_entries) or
+                (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            _, asset = self._entries.popitem(last=False)
+            self.nbytes -= self._asset_size(asset)
+            self.evictions += 1
+
+    @staticmethod
+    def _asset_size(asset):
+        if isinstance(asset, pygame.Surface):
+            return asset.get_pitch() * asset.get_height()
+        return getattr(asset, 'nbytes', 0)
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        return {'entries': len(self._entries),
+                'bytes': self.nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                }
+
+
+ASSET_CACHE = AssetCache()
+
+
+def load_cached_image(name, colorkey=None, style=None):
+    return ASSET_CACHE.get_image(name, colorkey, style)
+
+
+class AssetFuture:
+    """An image that may still be decoding on an AssetLoader thread.
+
+    result() returns the converted surface, blocking until it is decoded
+    if need be, and must be called from the main thread because that is
+    where convert() has to run.
+    """
+    def __init__(self, key, decoded, cache=ASSET_CACHE):
+        self.key = key
+        self._decoded = decoded  # concurrent.futures.Future of the unconverted surface
+        self._cache = cache
+        self._surface = None
+        self._callbacks = []
+
+    def decoded(self):
+        return self._decoded is None or self._decoded.done()
+
+    def done(self):
+        return self._surface is not None
+
+    def result(self):
+        if self._surface is None:
+            colorkey = self.key[1]
+            self._surface = self._cache.get(
+                self.key, lambda: _finish_image(self._decoded.result(), colorkey))
+            callbacks, self._callbacks = self._callbacks, []
+            for callback in callbacks:
+                callback(self._surface)
+        return self._surface
+
+    def add_done_callback(self, callback):
+        """Call callback(surface) once converted, right away if it already is."""
+        if self._surface is None:
+            self._callbacks.append(callback)
+        else:
+            callback(self._surface)
+
+
+class AssetLoader:
+    """Decodes images on a thread pool while the main thread keeps drawing.
+
+    File reads and image decoding release the GIL, so they overlap with the
+    main loop; pump() then converts whatever has finished decoding, which is
+    the only step tied to the display. Converted surfaces land in the asset
+    cache, so sprites built afterwards just hit it.
+    """
+    def __init__(self, workers=4, cache=ASSET_CACHE):
+        self.cache = cache
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix='asset-loader')
+        self._futures = OrderedDict()
+
+    def image(self, name, colorkey=None, style=None):
+        key = (name, colorkey, style)
+        future = self._futures.get(key)
+        if future is None:
+            if key in self.cache:
+                future = AssetFuture(key, None, self.cache)
+                future.result()
+            else:
+                future = AssetFuture(key, self._pool.submit(_decode_image, name), self.cache)
+            self._futures[key] = future
+        return future
+
+    def pending(self):
+        return [future for future in self._futures.values() if not future.done()]
+
+    def progress(self):
+        if not self._futures:
+            return 1.0
+        return 1.0 - len(self.pending()) / len(self._futures)
+
+    def pump(self, timeout=0):
+        """Convert decoded images, first waiting up to timeout seconds for one.
+
+        Returns the number still outstanding.
+        """
+        pending = self.pending()
+        if timeout and pending and not any(f.decoded() for f in pending):
+            concurrent.futures.wait([f._decoded for f in pending], timeout,
+                                    concurrent.futures.FIRST_COMPLETED)
+        for future in pending:
+            if future.decoded():
+                future.result()
+        return len(self.pending())
+
+    def wait(self):
+        for future in self.pending():
+            future.result()
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+
+def draw_loading_screen(surface, progress):
+    """Progress bar for AssetLoader.progress() on an otherwise blank screen."""
+    surface.fill((0, 0, 0))
+    bar = pygame.Rect(0, 0, surface.get_width() // 2, 12)
+    bar.center = surface.get_rect().center
+    pygame.draw.rect(surface, (255, 255, 255), bar, 1)
+    filled = bar.inflate(-4, -4)
+    filled.width = int(filled.width * progress)
+    surface.fill((255, 255, 255), filled)
+
+
+class TransformCache:
+    """Rotated, flipped and scaled variants (and masks) of source surfaces, computed once.
+
+    Results are kept per source surface, weakly so they go away with it,
+    and are shared, so do not draw onto them. Rotation tables are built
+    whole, every rotation_step degrees, with rects centred on the origin:
+    move one to the sprite's centre instead of calling get_rect() again.
+    """
+    def __init__(self, rotation_step=12):
+        self.rotation_step = rotation_step
+        self._entries = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, surface, key, build):
+        entries = self._entries.setdefault(surface, {})
+        value = entries.get(key)
+        if value is None:
+            self.misses += 1
+            value = entries[key] = build()
+        else:
+            self.hits += 1
+        return value
+
+    def flipped(self, surface, flip_x=True, flip_y=False):
+        if not (flip_x or flip_y):
+            return surface
+        return self._get(surface, ('flip', flip_x, flip_y),
+                         lambda: pygame.transform.flip(surface, flip_x, flip_y))
+
+    def scaled(self, surface, size):
+        size = tuple(size)
+        return self._get(surface, ('scale', size), lambda: pygame.transform.scale(surface, size))
+
+    def mask(self, surface):
+        return self._get(surface, ('mask',), lambda: pygame.mask.from_surface(surface))
+
+    def rotations(self, surface, step=None):
+        """(image, rect) for every step degrees; entry i is rotated by i * step."""
+        step = step or self.rotation_step
+
+        def build():
+            table = []
+            for angle in range(0, 360, step):
+                image = pygame.transform.rotate(surface, angle) if angle else surface
+                table.append((image, image.get_rect(center=(0, 0))))
+            return tuple(table)
+        return self._get(surface, ('rotate', step), build)
+
+    def rotated(self, surface, angle, step=None):
+        """The precomputed (image, rect) closest to angle degrees."""
+        step = step or self.rotation_step
+        table = self.rotations(surface, step)
+        return table[round(angle / step) % len(table)]
+
+
+TRANSFORMS = TransformCache()
+
+
+class InputMap:
+    """Turns a frame's events into actions through a (type, key) dispatch table.
+
+    Bindings with key None match every key of that event type. A binding
+    to the release action is checked against one pygame.key.get_pressed()
+    snapshot per frame: if a key in held is still down, its action replaces
+    the release, so letting go of one of two held keys does not stop.
+    """
+    def __init__(self, bindings, held=(), release=None):
+        self.bindings = dict(bindings)
+        self.held = tuple(held)  # (key, action) pairs, first one down wins
+        self.release = release
+
+    def event_types(self):
+        return sorted({event_type for event_type, _ in self.bindings})
+
+    def allow_events(self):
+        """Have SDL drop every event type without a binding before it is queued."""
+        types = self.event_types()
+        queued = pygame.event.get(types)  # blocking flushes the queue, keep what we want
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed(types)
+        for event in queued:
+            pygame.event.post(event)
+
+    def lookup(self, event):
+        action = self.bindings.get((event.type, getattr(event, 'key', None)))
+        if action is None:
+            action = self.bindings.get((event.type, None))
+        return action
+
+    def actions(self, events, keys=None):
+        """Actions for events in order; keys overrides the key-state snapshot."""
+        actions = []
+        for event in events:
+            action = self.lookup(event)
+            if action is None:
+                continue
+            if action == self.release and self.held:
+                if keys is None:
+                    keys = pygame.key.get_pressed()
+                action = next((a for key, a in self.held if keys[key]), action)
+            actions.append(action)
+        return actions
+
+
+class Scene:
+    """What GameLoop drives. Subclasses override the hooks they need.
+
+    update() advances the simulation by one fixed step. draw(alpha) renders;
+    alpha in [0, 1) is how far real time has got between the last step and
+    the next one, for interpolating positions. Set running to False to stop.
+    """
+    running = True
+
+    def handle_events(self, events):
+        for event in events:
+            self.handle_event(event)
+
+    def handle_event(self, event):
+        pass
+
+    def update(self):
+        pass
+
+    def draw(self, alpha):
+        pass
+
+
+class GameLoop:
+    """Fixed-timestep loop: updates at step_rate, draws as often as max_fps allows.
+
+    Real time is accumulated and spent in whole update steps, so simulation
+    speed does not depend on how fast frames are drawn; after a stall at most
+    max_steps updates run before drawing again.
+    """
+    def __init__(self, scene, step_rate=60, max_fps=60, max_steps=5, profiler=None, clock=None):
+        self.scene = scene
+        self.step_ms = 1000.0 / step_rate
+        self.max_fps = max_fps
+        self.max_steps = max_steps
+        self.profiler = profiler if profiler is not None else NullFrameProfiler()
+        self.clock = clock if clock is not None else pygame.time.Clock()
+        self.steps = 0
+        self._lag = 0.0
+
+    def tick(self, elapsed_ms):
+        """Run one frame as if elapsed_ms had passed since the last one."""
+        scene = self.scene
+        self.profiler.begin_frame(elapsed_ms)
+        scene.handle_events(pygame.event.get())
+        self.profiler.lap('events')
+
+        self._lag = min(self._lag + elapsed_ms, self.max_steps * self.step_ms)
+        while self._lag >= self.step_ms and scene.running:
+            scene.update()
+            self.steps += 1
+            self._lag -= self.step_ms
+        if scene.running:
+            scene.draw(self._lag / self.step_ms)
+        self.profiler.end_frame()
+
+    def run(self):
+        while self.scene.running:
+            self.tick(self.clock.tick(self.max_fps))
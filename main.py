@@ -1,9 +1,50 @@
-from mygameslib import *
+import sys
+from profiling import install_startup_profiler, startup_section, FrameProfiler
+
+if '--profile-startup' in sys.argv:
+    install_startup_profiler()
+
+with startup_section('import pygame'):
+    import pygame
+with startup_section('import mygameslib'):
+    from mygameslib import *
+
+
+def _option(name):
+    return sys.argv[sys.argv.index(name) + 1] if name in sys.argv else None
 
 
 def main():
-    G = Game()
+    if '--replay' in sys.argv:
+        G = Game(headless=True)
+        ReplayDriver.load(_option('--replay')).play(G)
+        print(G.snapshot())
+        return
+
+    profiler = None
+    if '--frame-stats' in sys.argv or '--trace' in sys.argv:
+        profiler = FrameProfiler(overlay='--frame-stats' in sys.argv)
+
+    render_mode = RenderMode.FLIP if '--flip' in sys.argv else RenderMode.DIRTY
+    if '--stress' in sys.argv:
+        pygame.display.init()
+        pygame.display.set_mode((600, 337))
+        pygame.display.set_caption('%s characters' % _option('--stress'))
+        scene = StressScene(int(_option('--stress')), profiler=profiler, render_mode=render_mode)
+        GameLoop(scene, profiler=profiler).run()
+        pygame.quit()
+        if profiler is not None:
+            print(profiler.summary())
+            if '--trace' in sys.argv:
+                profiler.dump(_option('--trace'))
+        return
+    recorder = InputRecorder() if '--record' in sys.argv else None
+    G = Game(render_mode=render_mode, profiler=profiler, recorder=recorder)
     G.run()
+    if '--trace' in sys.argv:
+        profiler.dump(_option('--trace'))
+    if recorder is not None:
+        recorder.save(_option('--record'))
 
 
 if __name__ == '__main__':
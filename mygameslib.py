@@ -1,11 +1,18 @@
 import os
+import json
+import random
 from enum import Enum
-import itertools
+from collections import OrderedDict
+from operator import attrgetter
 import pygame
-from PIL import Image
-
-MAIN_DIR = os.path.split(os.path.abspath(__file__))[0]
-DATA_DIR = os.path.join(MAIN_DIR, 'data')
+from profiling import startup_section, finish_startup, NullFrameProfiler
+from engine import (DATA_DIR, load_asset_pack, load_image, init_mixer, load_font, load_sound,
+                    AssetCache, ASSET_CACHE, load_cached_image, AssetLoader, draw_loading_screen,
+                    TRANSFORMS, InputMap, Scene, GameLoop)
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class CharacterState(Enum):
     STOPPED = 1
@@ -34,138 +41,455 @@ IMAGES_DICT = {CharacterStyle.BIG:
                     CharacterState.CROUCHING: ['mario6_mini.png'],
                     },
                }
+# styles without art of their own: the style whose frames they recolour, and the tint
+DERIVED_STYLES = {CharacterStyle.FIRE: (CharacterStyle.BIG, (255, 190, 150)),
+                  }
+# updates each frame of a state's animation stays on screen; higher is slower
+ANIMATION_CADENCE = {CharacterState.RUNNING: 2,
+                     }
+DEFAULT_CADENCE = 2
+BACKDROP_IMAGE = 'supermariobackground.jpg'
+LUCKY_BLOCK_IMAGE = 'luckyblock.png'
+JUMP_SOUND = 'smb_jump-small.wav'
+THEME_MUSIC = '01-main-theme-overworld.mp3'
 GRAVITY = 1
 GROUND_LEVEL = 293
+LEVEL_DIR = os.path.join(DATA_DIR, 'levels')
+DEFAULT_LEVEL = os.path.join(LEVEL_DIR, '1-1')
+LEVEL_VERSION = 1
+SOLID_TILES = '#'
+
+class Action(Enum):
+    RIGHT = 1
+    LEFT = 2
+    JUMP = 3
+    CROUCH = 4
+    STOP = 5
+    PAUSE = 6
+    QUIT = 7
+
+# (event type, key) -> action; key None matches any key
+KEY_BINDINGS = {(pygame.QUIT, None): Action.QUIT,
+                (pygame.KEYDOWN, pygame.K_ESCAPE): Action.PAUSE,
+                (pygame.KEYDOWN, pygame.K_RIGHT): Action.RIGHT,
+                (pygame.KEYDOWN, pygame.K_LEFT): Action.LEFT,
+                (pygame.KEYDOWN, pygame.K_UP): Action.JUMP,
+                (pygame.KEYDOWN, pygame.K_DOWN): Action.CROUCH,
+                (pygame.KEYUP, pygame.K_RIGHT): Action.STOP,
+                (pygame.KEYUP, pygame.K_LEFT): Action.STOP,
+                (pygame.KEYUP, pygame.K_DOWN): Action.STOP,
+                }
+# keys that keep Mario going when another one is released
+HELD_KEYS = ((pygame.K_RIGHT, Action.RIGHT), (pygame.K_LEFT, Action.LEFT))
+
+
+class RenderMode(Enum):
+    """How Game.render presents a frame. Both modes draw the same CameraGroup."""
+    FLIP = 1    # repaint_rect() the whole screen, so every sprite is redrawn, then display.flip()
+    DIRTY = 2   # redraw only the changed regions and display.update() just those rects
 
 def repeat_image(image_path, nrepeat=2):
-    image = Image.open(image_path)
-
-    width, height = image.size[0], image.size[1]
-
-    total_width = width * nrepeat
-
-    new_im = Image.new(image.mode, (total_width, height))
-
-    x_offset = 0
-    for i in range(0, nrepeat):
-        new_im.paste(image, (x_offset, 0))
-        x_offset += width
-
-    return new_im
+    image = repeat_surface(pygame.image.load(image_path), nrepeat)
+    return surface_to_pil(image)
+
+
+def pil_to_surface(image):
+    """Wrap a PIL image in a pygame surface.
+
+    tobytes() is the only copy: frombuffer shares that buffer rather than
+    copying it again like fromstring does.
+    """
+    if image.mode not in ('RGB', 'RGBA', 'RGBX'):
+        image = image.convert('RGBA' if 'transparency' in image.info or 'A' in image.getbands() else 'RGB')
+    return pygame.image.frombuffer(image.tobytes(), image.size, image.mode)
+
+
+def _raw_mode(surface):
+    # byte order of the pixel channels, assuming a little-endian packed format
+    names = dict(zip(surface.get_masks(), 'RGBA'))
+    return ''.join(names.get(0xff << (8 * i), 'X') for i in range(surface.get_bytesize()))
+
+
+def surface_to_pil(surface):
+    """View a 24/32-bit pygame surface as a PIL image.
+
+    When the surface is already in RGB(A/X) byte order PIL reads the pixel
+    buffer in place (the surface stays locked while the image is alive);
+    other orders, such as the usual BGRX display format, cost one decode.
+    """
+    from PIL import Image  # only the image pipeline needs PIL, so import it on first use
+    if surface.get_bytesize() < 3:
+        unpacked = pygame.Surface(surface.get_size(), pygame.SRCALPHA, 32)
+        unpacked.blit(surface, (0, 0))
+        surface = unpacked
+    raw_mode = _raw_mode(surface)
+    mode = {'RGBX': 'RGBX', 'RGBA': 'RGBA', 'BGRX': 'RGB', 'BGRA': 'RGBA', 'RGB': 'RGB', 'BGR': 'RGB'}[raw_mode]
+    return Image.frombuffer(mode, surface.get_size(), surface.get_buffer(), 'raw',
+                            raw_mode, surface.get_pitch(), 1)
+
+
+def repeat_surface(surface, nrepeat=2):
+    """Tile a surface horizontally into one new surface, without PIL."""
+    width, height = surface.get_size()
+    repeated = pygame.Surface((width * nrepeat, height), 0, surface)
+    for i in range(nrepeat):
+        repeated.blit(surface, (i * width, 0))
+    return repeated
+
+
+def flip_in_place(surface):
+    """Mirror a surface horizontally by reversing its pixel columns in place."""
+    if numpy is None:
+        surface.blit(pygame.transform.flip(surface, 1, 0), (0, 0))
+        return surface
+    # packed 24-bit pixels, e.g. a JPG straight from image.load, have no 2D view
+    if surface.get_bytesize() == 3:
+        pixels = pygame.surfarray.pixels3d(surface)
+    else:
+        pixels = pygame.surfarray.pixels2d(surface)
+    pixels[:] = pixels[::-1]
+    del pixels  # unlock the surface
+    return surface
+
+
+def preprocess_image(surface, repeat=1, flip=False, colorkey=None):
+    """Apply repeat, flip and colorkey in one pass over an owned surface."""
+    if repeat > 1:
+        surface = repeat_surface(surface, repeat)
+    if flip:
+        flip_in_place(surface)
+    if colorkey is not None:
+        if colorkey == -1:
+            colorkey = surface.get_at((0, 0))
+        surface.set_colorkey(colorkey, pygame.RLEACCEL)
+    return surface
 
 
-def load_image(name, colorkey=None):
-    fullname = os.path.join(DATA_DIR, name)
-    try:
-        image = pygame.image.load(fullname)
-    except pygame.error as message:
-        print('Cannot load image:', fullname)
-        raise SystemExit(message)
-    image = image.convert()
+def tint_image(surface, tint):
+    """Copy of a colorkeyed surface multiplied by tint, keeping its transparent pixels."""
+    colorkey = surface.get_colorkey()
+    image = surface.copy()
+    image.fill(tint, special_flags=pygame.BLEND_RGB_MULT)
     if colorkey is not None:
-        if colorkey is -1:
-            colorkey = image.get_at((0, 0))
+        transparent = pygame.mask.from_surface(surface)
+        transparent.invert()
+        transparent.to_surface(image, setcolor=colorkey, unsetcolor=None)
         image.set_colorkey(colorkey, pygame.RLEACCEL)
     return image
 
 
-def load_sound(name):
-    class NoneSound:
-        def play(self): pass
-
-    if not pygame.mixer or not pygame.mixer.get_init():
-        return NoneSound()
-    fullname = os.path.join(DATA_DIR, name)
-
-    sound = pygame.mixer.Sound(fullname)
-
-    return sound
-
-class CycleCounter(itertools.cycle):
-    def __init__(self, iterable):
-        self.iterable = iterable
-
-    def __iter__(self):
-        return itertools.cycle.__iter__(self)
-
-class FixedObjectSprite(pygame.sprite.Sprite):
+class AudioManager:
+    """Preloaded bank of short effects plus streamed background music.
+
+    Effects are decoded once into the bank and played on a fixed pool of
+    mixer channels. When every voice is busy, the one playing the
+    lowest-priority (then oldest) effect is stolen, as long as the new
+    effect's priority is at least as high. Music is streamed from disk by
+    pygame.mixer.music, never decoded whole.
+
+    The mixer is only started by start(), or by the first play() or
+    play_music(); effects preloaded before that are decoded then. This keeps
+    mixer start-up off the path to the first frame.
+    """
+    def __init__(self, voices=8, enabled=True):
+        self.enabled = enabled  # until start() finds out whether the mixer works
+        self.started = False
+        self.voices = voices
+        self.bank = {}
+        self._pending = []  # preloaded before start()
+        self._channels = []
+        self._playing = {}  # channel index -> (priority, sequence number)
+        self._sequence = 0
+
+    def start(self):
+        """Start the mixer and decode the pending effects; returns whether sound is enabled."""
+        if self.started:
+            return self.enabled
+        self.started = True
+        self.enabled = self.enabled and init_mixer()
+        if self.enabled:
+            pygame.mixer.set_num_channels(self.voices)
+            self._channels = [pygame.mixer.Channel(i) for i in range(self.voices)]
+            self.preload(*self._pending)
+        self._pending = []
+        return self.enabled
+
+    def preload(self, *names):
+        if not self.started:
+            self._pending.extend(names)
+        elif self.enabled:
+            for name in names:
+                if name not in self.bank:
+                    self.bank[name] = load_sound(name)
+
+    def _voice(self, priority):
+        for i, channel in enumerate(self._channels):
+            if not channel.get_busy():
+                return i
+        i = min(self._playing, key=self._playing.get, default=None)
+        if i is not None and self._playing[i][0] <= priority:
+            return i
+        return None
+
+    def play(self, name, priority=0):
+        """Play a banked effect; returns its channel, or None if it was dropped."""
+        if not self.start():
+            return None
+        self.preload(name)
+        i = self._voice(priority)
+        if i is None:
+            return None
+        channel = self._channels[i]
+        channel.play(self.bank[name])
+        self._sequence += 1
+        self._playing[i] = (priority, self._sequence)
+        return channel
+
+    def play_music(self, name, loops=-1, volume=0.5):
+        if not self.start():
+            return
+        pygame.mixer.music.load(os.path.join(DATA_DIR, name))
+        pygame.mixer.music.set_volume(volume)
+        pygame.mixer.music.play(loops)
+
+    def stop_music(self):
+        if self.started and self.enabled:
+            pygame.mixer.music.stop()
+
+
+class AnimationTable:
+    """Precomputed frame schedules, one flat tuple per state.
+
+    schedules[state][tick % len(schedule)] is the index of the frame to show
+    tick updates after entering the state, with each frame repeated for its
+    state's cadence, so animating is integer arithmetic and a lookup.
+    """
+    def __init__(self, frame_counts, cadences=ANIMATION_CADENCE):
+        self.schedules = {}
+        for state, count in frame_counts.items():
+            cadence = cadences.get(state, DEFAULT_CADENCE) if count > 1 else 1
+            self.schedules[state] = tuple(i for i in range(count) for _ in range(cadence))
+
+    def frame_index(self, state, tick):
+        schedule = self.schedules[state]
+        return schedule[tick % len(schedule)]
+
+
+class FrameAtlas:
+    """All frames of a character style, in both orientations, on one surface.
+
+    Row 0 holds the frames as drawn (facing right) and row 1 their mirror
+    images. frames[direction_index(d)][state][sub_state] are subsurface views
+    into the atlas, so turning around never allocates. sequences holds the
+    same surfaces laid out along each state's AnimationTable schedule, and
+    masks maps every one of them to its collision mask.
+    """
+    def __init__(self, images, cadences=ANIMATION_CADENCE):
+        width = sum(img.get_width() for v in images.values() for img in v)
+        height = max(img.get_height() for v in images.values() for img in v)
+        first = next(iter(images.values()))[0]
+        colorkey = first.get_colorkey()
+
+        self.surface = pygame.Surface((width, 2 * height)).convert()
+        if colorkey is not None:
+            self.surface.fill(colorkey)
+            self.surface.set_colorkey(colorkey)
+        self.frames = ({}, {})
+        self.masks = {}  # frame subsurface -> pygame.mask.Mask
+
+        x = 0
+        for state, v in images.items():
+            for frames in self.frames:
+                frames[state] = []
+            for img in v:
+                w, h = img.get_size()
+                self.surface.blit(img, (x, 0))
+                self.surface.blit(pygame.transform.flip(img, 1, 0), (x, height))
+                for row, frames in enumerate(self.frames):
+                    frame = self.surface.subsurface((x, row * height, w, h))
+                    frames[state].append(frame)
+                    self.masks[frame] = pygame.mask.from_surface(frame)
+                x += w
+
+        self.animation = AnimationTable({k: len(v) for k, v in images.items()}, cadences)
+        self.sequences = tuple({state: tuple(frames[state][i] for i in schedule)
+                                for state, schedule in self.animation.schedules.items()}
+                               for frames in self.frames)
+        self.nbytes = self.surface.get_pitch() * self.surface.get_height()
+
+    @staticmethod
+    def direction_index(direction):
+        return 0 if direction > 0 else 1
+
+    @classmethod
+    def for_style(cls, style):
+        def build():
+            if style in DERIVED_STYLES:
+                base, tint = DERIVED_STYLES[style]
+                images = {k: [tint_image(load_cached_image(filename, -1, base), tint) for filename in v]
+                          for k, v in IMAGES_DICT[base].items()}
+            else:
+                images = {k: [load_cached_image(filename, -1, style) for filename in v]
+                          for k, v in IMAGES_DICT[style].items()}
+            return cls(images)
+        return ASSET_CACHE.get(('<atlas>', -1, style), build)
+
+
+_SCREEN_AREAS = {}
+
+
+def screen_area():
+    """Rect of the display surface, shared by every sprite; do not mutate it."""
+    size = pygame.display.get_surface().get_size()
+    area = _SCREEN_AREAS.get(size)
+    if area is None:
+        area = _SCREEN_AREAS[size] = pygame.Rect((0, 0), size)
+    return area
+
+
+class FixedObjectSprite(pygame.sprite.DirtySprite):
     def __init__(self):
-        pygame.sprite.Sprite.__init__(self)  # call Sprite initializer
-        screen = pygame.display.get_surface()
-        self.area = screen.get_rect()
-
-    def pan(self, pan_amount):
-        if self.rect.right + pan_amount < self.area.right:
-            pan_amount = 600 + pan_amount
-        elif self.rect.left + pan_amount > self.area.left:
-            pan_amount = pan_amount - 600
-        else:
-            move = pan_amount
-
-        self.rect.move_ip((pan_amount, 0))
+        pygame.sprite.DirtySprite.__init__(self)  # call Sprite initializer
+        self.area = screen_area()
+
+
+class ImageTileSource:
+    """Vertical strips of one backdrop image, decoded once.
+
+    With repeat=True the image tiles endlessly to the right, so tile_width
+    has to divide the image width.
+    """
+    def __init__(self, name=BACKDROP_IMAGE, tile_width=None, repeat=True):
+        self.image = load_cached_image(name)
+        width, self.height = self.image.get_size()
+        if tile_width is None:
+            tile_width = next(w for w in range(128, 0, -1) if width % w == 0)
+        if repeat and width % tile_width:
+            raise ValueError('tile width %d does not divide image width %d' % (tile_width, width))
+        self.tile_width = tile_width
+        self.repeat = repeat
+        self._tiles = [self.image.subsurface((x, 0, min(tile_width, width - x), self.height))
+                       for x in range(0, width, tile_width)]
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def tile(self, index):
+        if self.repeat:
+            index %= len(self._tiles)
+        elif not 0 <= index < len(self._tiles):
+            return None
+        return self._tiles[index]
+
+
+class ChunkedTileSource:
+    """Backdrop tiles streamed from numbered image files in a directory.
+
+    Only the tiles near the camera are kept decoded, in a small LRU cache,
+    so memory does not grow with level width. See split_backdrop().
+    """
+    def __init__(self, directory, pattern='tile_%04d.png', cache_tiles=16, repeat=False):
+        self.directory = directory
+        self.pattern = pattern
+        self.repeat = repeat
+        self._count = 0
+        while os.path.exists(os.path.join(directory, pattern % self._count)):
+            self._count += 1
+        if not self._count:
+            raise ValueError('no backdrop tiles in %s' % directory)
+        self._cache = AssetCache(max_entries=cache_tiles)
+        self.tile_width, self.height = self.tile(0).get_size()
+
+    def __len__(self):
+        return self._count
+
+    def tile(self, index):
+        if self.repeat:
+            index %= self._count
+        elif not 0 <= index < self._count:
+            return None
+        path = os.path.join(self.directory, self.pattern % index)
+        return self._cache.get((path, None, None), lambda: load_image(path))
+
+
+def split_backdrop(name, directory, tile_width, pattern='tile_%04d.png'):
+    """Cut a backdrop image into the numbered tiles ChunkedTileSource reads."""
+    source = ImageTileSource(name, tile_width, repeat=False)
+    os.makedirs(directory, exist_ok=True)
+    for index in range(len(source)):
+        pygame.image.save(source.tile(index), os.path.join(directory, pattern % index))
+    return len(source)
 
 
 class LevelBackdrop(FixedObjectSprite):
-    def __init__(self):
+    """Screen-sized view of a tiled backdrop at the current camera offset.
+
+    Panning only moves the camera and re-blits the handful of visible tiles.
+    """
+    def __init__(self, source=None):
         FixedObjectSprite.__init__(self)
-        self.image_path = os.path.join(DATA_DIR, 'supermariobackground.jpg')
-        self._load_image()
+        self.source = source if source is not None else ImageTileSource()
+        self.image = pygame.Surface(self.area.size).convert()
         self.rect = self.image.get_rect()
         self.rect.topleft = (0, 0)
-        self.move = 4
+        self.camera_x = 0
+        self._draw_tiles()
+
+    def _draw_tiles(self):
+        tile_width = self.source.tile_width
+        index, x = divmod(self.camera_x, tile_width)
+        x = -x
+        while x < self.rect.width:
+            tile = self.source.tile(index)
+            if tile is None:
+                self.image.fill((0, 0, 0), (x, 0, tile_width, self.rect.height))
+            else:
+                self.image.blit(tile, (x, 0))
+            x += tile_width
+            index += 1
+
+    def pan(self, pan_amount):
+        self.scroll_to(self.camera_x - pan_amount)
 
-    def _load_image(self):
-        image = repeat_image(self.image_path, 2)
-        mode = image.mode
-        size = image.size
-        data = image.tobytes()
-        self.image = pygame.image.fromstring(data, size, mode).convert()
+    def scroll_to(self, camera_x):
+        if camera_x != self.camera_x:
+            self.camera_x = camera_x
+            self._draw_tiles()
+            self.dirty = 1
 
 
 class LuckyBlock(pygame.sprite.DirtySprite):
-    def __init__(self):
+    def __init__(self, midbottom=(300, 210)):
         pygame.sprite.DirtySprite.__init__(self)
-        screen = pygame.display.get_surface()
-        self.area = screen.get_rect()
-        self.image = load_image('luckyblock.png', (250, 250, 250))
+        self.area = screen_area()
+        self.image = load_cached_image(LUCKY_BLOCK_IMAGE, (250, 250, 250))
+        self.mask = TRANSFORMS.mask(self.image)
         self.rect = self.image.get_rect()
-        self.rect.midbottom = (300, 210)
-
-    def pan(self, pan_amount):
-        self.rect.move_ip((pan_amount, 0))
+        self.rect.midbottom = midbottom
+        self.layer = 1
 
 
 class CharacterSprite(pygame.sprite.DirtySprite):
     def __init__(self, start_position):
         pygame.sprite.DirtySprite.__init__(self)  # call Sprite initializer
-        screen = pygame.display.get_surface()
-        self.area = screen.get_rect()
+        self._batch = None  # PhysicsBatch owning our vectors, if any
+        self._body = None
+        self.area = screen_area()
         self._load_images()
         self.layer = 1
         self._direction = 1
         self._state = CharacterState.STOPPED
-        self._sub_states = itertools.cycle(range(len(self._images[self._state])))
-        self._sub_state = next(self._sub_states)
+        self._anim_tick = 0  # updates since entering the current state
         self.rect = self.image.get_rect()
         self.rect.midbottom = start_position
         self.velocity = [0, 0]
-        self.acceleration = [0, GRAVITY]
-        self._cycle_cadence = 2  # higher is slower
-        self._wait_cycle = itertools.cycle(range(self._cycle_cadence))
+        self.acceleration = (0, GRAVITY)  # never mutated, so a tuple will do
+        self._drawn = None
 
     def _load_images(self):
-        self._images = {}
-        self._state_cycles = {}
-
-
-        for k, v in IMAGES_DICT[self._style].items():
-            self._images[k] = [load_image(filename, -1) for filename in v]
-            if len(v) > 1:
-                self._state_cycles[k] = itertools.cycle(range(len(v)))
-
-    def _flip_images(self):
-        for k, v in self._images.items():
-            self._images[k] = [pygame.transform.flip(x, 1, 0) for x in v]
+        self._atlas = FrameAtlas.for_style(self._style)
+        self._images = self._atlas.frames[FrameAtlas.direction_index(1)]
+        self._sequences = self._atlas.sequences[FrameAtlas.direction_index(1)]
 
     @property
     def direction(self):
@@ -175,7 +499,8 @@ class CharacterSprite(pygame.sprite.DirtySprite):
     def direction(self, direction):
         if self._direction != direction:
             self._direction = direction
-            self._flip_images()
+            self._images = self._atlas.frames[FrameAtlas.direction_index(direction)]
+            self._sequences = self._atlas.sequences[FrameAtlas.direction_index(direction)]
 
     @property
     def state(self):
@@ -183,23 +508,39 @@ class CharacterSprite(pygame.sprite.DirtySprite):
 
     @state.setter
     def state(self, new_state):
+        if new_state != self._state:
+            self._anim_tick = 0
         self._state = new_state
-
-    def _cycle_sub_state(self):
-        sub_states = self._state_cycles.get(self.state, False)
-        if sub_states:
-            if next(self._wait_cycle) == self._cycle_cadence - 1:
-                sub_states = self._state_cycles[self.state]
-                self._sub_state = next(sub_states)
-        else:
-            self._sub_state = 0
+        if self._batch is not None:
+            self._batch.state[self._body] = new_state.value
 
     @property
     def image(self):
-        try:
-            return self._images[self.state][self._sub_state]
-        except:
-            print('')
+        sequence = self._sequences[self._state]
+        return sequence[self._anim_tick % len(sequence)]
+
+    @property
+    def mask(self):
+        return self._atlas.masks[self.image]
+
+    def reset(self, midbottom, direction=1):
+        """Put a recycled sprite back in its just-created state, standing at midbottom."""
+        self.direction = direction
+        self._state = CharacterState.STOPPED
+        self._anim_tick = 0
+        self.velocity[0] = self.velocity[1] = 0
+        self.rect.size = self.image.get_size()
+        self.rect.midbottom = midbottom
+        self._drawn = None
+        self.dirty = 1
+
+    def refresh_dirty(self):
+        # flag for repaint only if the frame or position changed since the last draw
+        drawn = (self.image, tuple(self.rect))
+        if drawn != self._drawn:
+            self._drawn = drawn
+            if not self.dirty:
+                self.dirty = 1
 
     def _on_solid_surface(self):
         if self.area.bottom == 337:
@@ -216,6 +557,7 @@ class Mario(CharacterSprite):
         CharacterSprite.__init__(self, start_position)
         self.running_speed = 4
         self.jumping_speed = 20
+        self.audio = None  # AudioManager for sound effects, set by Game
 
     def run(self, direction):
         self.direction = direction
@@ -234,6 +576,8 @@ class Mario(CharacterSprite):
         if self._on_solid_surface():
             self.state = CharacterState.JUMPING
             self.velocity[1] = -self.jumping_speed
+            if self.audio is not None:
+                self.audio.play(JUMP_SOUND, priority=1)
 
     def stop(self):
         if self.velocity[1] == 0:
@@ -256,107 +600,1162 @@ class Mario(CharacterSprite):
                     self.state = CharacterState.STOPPED
 
     def update(self):
-        self._cycle_sub_state()
-        self._update_vectors()
-        self._update_state()
+        self._anim_tick += 1
+        if self._batch is None:
+            self._update_vectors()
+            self._update_state()
+
+_ANIM_TICK = attrgetter('_anim_tick')
+
+
+class PhysicsBatch:
+    """Structure-of-arrays physics for many characters at once.
+
+    Position (centerx, bottom), velocity and acceleration of every member live
+    in shared NumPy buffers. A member's velocity and acceleration attributes
+    become row views into them, so code like sprite.velocity[0] = 0 keeps
+    working, and its update() only animates. step() integrates, clamps to the
+    ground and lands jumpers for all members in one go, then writes the
+    positions back to the members' rects. Frame sizes come from per-atlas
+    tables indexed by state and animation tick, so the rects are computed
+    in bulk and only assigned one by one. Given a view, step() only writes
+    the rects of members inside it or just leaving it; the others keep
+    their last rect until they come back. remove() copies the vectors back
+    into the sprite's own velocity list and acceleration, so members can
+    come and go without allocating.
+    """
+    def __init__(self, capacity=64, ground_level=GROUND_LEVEL):
+        if numpy is None:
+            raise RuntimeError('PhysicsBatch requires numpy')
+        self.ground_level = ground_level
+        self.sprites = []
+        self.position = numpy.zeros((capacity, 2))
+        self.velocity = numpy.zeros((capacity, 2))
+        self.acceleration = numpy.zeros((capacity, 2))
+        self.state = numpy.zeros(capacity, dtype=numpy.int8)
+        self.atlas = numpy.zeros(capacity, dtype=numpy.int16)  # index into the frame tables
+        self.shown = numpy.zeros(capacity, dtype=bool)  # rect was inside the last step's view
+        self._own = {}  # member -> its (velocity, acceleration) from before it joined
+        self._atlases = {}  # FrameAtlas -> index
+        self._frame_counts = self._frame_sizes = None
+
+    def __len__(self):
+        return len(self.sprites)
+
+    def _grow(self):
+        capacity = 2 * len(self.position)
+        for name in ('position', 'velocity', 'acceleration', 'state', 'atlas', 'shown'):
+            old = getattr(self, name)
+            new = numpy.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        for i, sprite in enumerate(self.sprites):
+            self._bind(sprite, i)
+
+    def _atlas_index(self, atlas):
+        index = self._atlases.get(atlas)
+        if index is None:
+            index = self._atlases[atlas] = len(self._atlases)
+            self._build_frame_tables()
+        return index
+
+    def _build_frame_tables(self):
+        # size of every frame in each atlas' animation sequences, indexed by
+        # [atlas, state value, tick % count]; mirrored frames are the same size
+        n_states = max(state.value for state in CharacterState) + 1
+        longest = max(len(sequence) for atlas in self._atlases for sequence in atlas.sequences[0].values())
+        counts = numpy.ones((len(self._atlases), n_states), dtype=numpy.int64)
+        sizes = numpy.zeros((len(self._atlases), n_states, longest, 2), dtype=numpy.int64)
+        for atlas, a in self._atlases.items():
+            for state, sequence in atlas.sequences[0].items():
+                counts[a, state.value] = len(sequence)
+                sizes[a, state.value, :len(sequence)] = [frame.get_size() for frame in sequence]
+        self._frame_counts, self._frame_sizes = counts, sizes
+
+    def _bind(self, sprite, i):
+        sprite._batch = self
+        sprite._body = i
+        sprite.velocity = self.velocity[i]
+        sprite.acceleration = self.acceleration[i]
+
+    def add(self, sprite):
+        i = len(self.sprites)
+        if i == len(self.position):
+            self._grow()
+        self.position[i] = sprite.rect.midbottom
+        self.velocity[i] = sprite.velocity
+        self.acceleration[i] = sprite.acceleration
+        self.state[i] = sprite.state.value
+        self.atlas[i] = self._atlas_index(sprite._atlas)
+        self.shown[i] = True  # written on the next step whatever the view
+        self.sprites.append(sprite)
+        self._own[sprite] = (sprite.velocity, sprite.acceleration)
+        self._bind(sprite, i)
+
+    def remove(self, sprite):
+        i = sprite._body
+        last = len(self.sprites) - 1
+        velocity, acceleration = self._own.pop(sprite)
+        velocity[:] = self.velocity[i]
+        row = self.acceleration[i]
+        if isinstance(acceleration, list):
+            acceleration[:] = row
+        elif acceleration[0] != row[0] or acceleration[1] != row[1]:
+            acceleration = tuple(row.tolist())  # a tuple changed through the view
+        sprite.velocity = velocity
+        sprite.acceleration = acceleration
+        sprite._batch = sprite._body = None
+        if i != last:
+            for array in (self.position, self.velocity, self.acceleration, self.state, self.atlas, self.shown):
+                array[i] = array[last]
+            self.sprites[i] = self.sprites[last]
+            self._bind(self.sprites[i], i)
+        self.sprites.pop()
+
+    def step(self, view=None):
+        n = len(self.sprites)
+        if not n:
+            return
+        position = self.position[:n]
+        velocity = self.velocity[:n]
+        state = self.state[:n]
+
+        position += velocity
+        velocity += self.acceleration[:n]
+
+        landed = position[:, 1] >= self.ground_level
+        position[landed, 1] = self.ground_level
+        velocity[landed & (velocity[:, 1] > 0), 1] = 0
+
+        jumped = landed & (state == CharacterState.JUMPING.value)
+        if jumped.any():
+            moving = velocity[:, 0] != 0
+            state[jumped & moving] = CharacterState.RUNNING.value
+            state[jumped & ~moving] = CharacterState.STOPPED.value
+            for i in numpy.flatnonzero(jumped).tolist():
+                sprite = self.sprites[i]
+                sprite._state = CharacterState(state[i])
+                sprite._anim_tick = 0
+
+        # the frame each member shows, as its image property would pick it
+        ticks = numpy.fromiter(map(_ANIM_TICK, self.sprites), numpy.int64, n)
+        atlas = self.atlas[:n]
+        frames = ticks % self._frame_counts[atlas, state]
+        rects = numpy.empty((n, 4), dtype=numpy.int64)
+        rects[:, 2:] = self._frame_sizes[atlas, state, frames]
+        rects[:, 0] = position[:, 0].astype(int) - rects[:, 2] // 2
+        rects[:, 1] = position[:, 1].astype(int) - rects[:, 3]
+        if view is None:
+            for sprite, rect in zip(self.sprites, rects.tolist()):
+                sprite.rect.update(rect)
+            return
+        left, top, width, height = rects.T
+        shown = self.shown[:n]
+        inside = ((left < view.right) & (left + width > view.left)
+                  & (top < view.bottom) & (top + height > view.top))
+        written = numpy.flatnonzero(inside | shown)
+        shown[:] = inside
+        sprites = self.sprites
+        for i, rect in zip(written.tolist(), rects[written].tolist()):
+            sprites[i].rect.update(rect)
+
+
+class CharacterPool:
+    """Recycles character sprites so spawning during play creates nothing new.
+
+    All sprites of a style share its FrameAtlas, so a pooled sprite only
+    carries its own position, velocity and animation state. Sprites are
+    made up front with reserve(); spawn() resets a free one and despawn()
+    takes it off every group and hands it back. With a PhysicsBatch,
+    spawned sprites join it and leave it again on despawn.
+    """
+    def __init__(self, style=CharacterStyle.BIG, size=0, cls=None, batch=None):
+        self.style = style
+        self.cls = cls if cls is not None else Mario
+        self.batch = batch
+        self.active = {}  # spawned sprites, in spawn order
+        self.created = 0
+        self._free = []
+        self.reserve(size)
+
+    def __len__(self):
+        return len(self.active)
 
-class Ground(pygame.sprite.DirtySprite):
-    def __init__(self, ground_level):
-        pygame.sprite.DirtySprite.__init__(self)
-        screen = pygame.display.get_surface()
-        self.area = screen.get_rect()
-        self.image = pygame.Surface((self.area.width, self.area.height - ground_level))
-        self.image.set_colorkey(self.image.get_at((0,0)), pygame.RLEACCEL)
-        self.rect = self.image.get_rect()
-        self.rect.top = ground_level
+    @property
+    def free(self):
+        """Sprites ready to spawn without creating a new one."""
+        return len(self._free)
+
+    def reserve(self, n):
+        while len(self._free) < n:
+            self._free.append(self._create())
+
+    def _create(self):
+        self.created += 1
+        return self.cls(style=self.style)
+
+    def spawn(self, midbottom, direction=1):
+        sprite = self._free.pop() if self._free else self._create()
+        sprite.reset(midbottom, direction)
+        self.active[sprite] = None
+        if self.batch is not None:
+            self.batch.add(sprite)
+        return sprite
+
+    def despawn(self, sprite):
+        del self.active[sprite]
+        if self.batch is not None:
+            self.batch.remove(sprite)
+        sprite.kill()
+        self._free.append(sprite)
+
+
+class Entity:
+    """Lightweight world object for levels with thousands of things in them.
+
+    Unlike the pygame sprites above, entities have no __dict__ and no
+    per-instance surfaces: the image comes from class-level or per-style
+    shared tables, and vectors are plain tuples. Draw them with an
+    EntityGroup; SpatialHash accepts them as they are.
+    """
+    __slots__ = ('rect',)
+
+    def update(self):
+        pass
+
+
+class BlockEntity(Entity):
+    """A static solid block sharing one image per class."""
+    __slots__ = ()
+    image = None
+    image_name = LUCKY_BLOCK_IMAGE
+    colorkey = (250, 250, 250)
+
+    def __init__(self, midbottom):
+        cls = type(self)
+        if cls.image is None:
+            cls.image = load_cached_image(cls.image_name, cls.colorkey)
+        self.rect = cls.image.get_rect(midbottom=midbottom)
+
+
+class CharacterEntity(Entity):
+    """A walking character animated from its style's shared FrameAtlas."""
+    __slots__ = ('velocity', 'direction', 'state', 'tick', '_atlas')
+
+    def __init__(self, midbottom, style=CharacterStyle.BIG, direction=1, speed=2):
+        self._atlas = FrameAtlas.for_style(style)
+        self.direction = direction
+        self.state = CharacterState.RUNNING if speed else CharacterState.STOPPED
+        self.tick = 0
+        self.velocity = (speed * direction, 0)
+        self.rect = self.image.get_rect(midbottom=midbottom)
+
+    @property
+    def image(self):
+        sequence = self._atlas.sequences[FrameAtlas.direction_index(self.direction)][self.state]
+        return sequence[self.tick % len(sequence)]
+
+    def update(self):
+        vx, vy = self.velocity
+        rect = self.rect
+        rect.move_ip(vx, vy)
+        vy += GRAVITY
+        if rect.bottom >= GROUND_LEVEL:
+            rect.bottom = GROUND_LEVEL
+            vy = 0
+        self.velocity = (vx, vy)
+        self.tick += 1
+
+
+class EntityGroup:
+    """Updates and draws entities, blitting them all in one Surface.blits call."""
+    def __init__(self, *entities):
+        self.entities = list(entities)
+
+    def __len__(self):
+        return len(self.entities)
+
+    def __iter__(self):
+        return iter(self.entities)
+
+    def add(self, *entities):
+        self.entities.extend(entities)
+
+    def remove(self, entity):
+        self.entities.remove(entity)
+
+    def update(self):
+        for entity in self.entities:
+            entity.update()
+
+    def draw(self, surface):
+        return surface.blits([(entity.image, entity.rect) for entity in self.entities])
+
+
+class SpatialHash:
+    """Uniform-grid broad phase for sprites with a rect.
+
+    Only the grid columns/rows a sprite's rect spans are stored, and move()
+    touches the grid only when that span changes. pan() shifts the whole
+    grid in O(1): call it after moving every hashed rect by the same amount,
+    and move() any hashed sprite that did not pan.
+    """
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self.offset = 0
+        self._cells = {}
+        self._spans = {}
+
+    def __len__(self):
+        return len(self._spans)
+
+    def __contains__(self, sprite):
+        return sprite in self._spans
+
+    def _span(self, rect):
+        size = self.cell_size
+        left = rect.left - self.offset
+        return (left // size, rect.top // size,
+                (left + max(rect.width, 1) - 1) // size, (rect.top + max(rect.height, 1) - 1) // size)
+
+    def _cell_keys(self, span):
+        x0, y0, x1, y1 = span
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                yield x, y
+
+    def insert(self, sprite):
+        span = self._span(sprite.rect)
+        self._spans[sprite] = span
+        for key in self._cell_keys(span):
+            self._cells.setdefault(key, {})[sprite] = None
+
+    def remove(self, sprite):
+        span = self._spans.pop(sprite)
+        for key in self._cell_keys(span):
+            cell = self._cells[key]
+            del cell[sprite]
+            if not cell:
+                del self._cells[key]
+
+    def move(self, sprite):
+        if self._span(sprite.rect) != self._spans[sprite]:
+            self.remove(sprite)
+            self.insert(sprite)
+
+    def pan(self, pan_amount):
+        self.offset += pan_amount
+
+    def query(self, rect):
+        """Sprites in the cells overlapping rect, in a deterministic order."""
+        found = {}
+        cells = self._cells
+        for key in self._cell_keys(self._span(rect)):
+            cell = cells.get(key)
+            if cell:
+                found.update(cell)
+        return list(found)
+
+
+class SolidTile(Entity):
+    """One solid cell of a level's tile grid. Tiles are not drawn; the backdrop shows them."""
+    __slots__ = ()
+
+    def __init__(self, rect):
+        self.rect = rect
+
+
+class LevelChunk:
+    """A fixed-width slice of a level: its tile rows and the objects starting in it.
+
+    The tile grid doubles as the chunk's spatial index, so query() only looks
+    at the cells under the rect instead of every solid in the chunk.
+    """
+    def __init__(self, index, x, y, tile_size, rows, objects=()):
+        self.index = index
+        self.rect = pygame.Rect(x, y, len(rows[0]) * tile_size if rows else 0, len(rows) * tile_size)
+        self.tile_size = tile_size
+        self.rows = rows
+        self.objects = list(objects)
+        self._grid = [[SolidTile(pygame.Rect(x + i * tile_size, y + j * tile_size, tile_size, tile_size))
+                       if cell in SOLID_TILES else None for i, cell in enumerate(row)]
+                      for j, row in enumerate(rows)]
+
+    def query(self, rect):
+        """Solid tiles overlapping rect, in row-major order."""
+        clipped = rect.clip(self.rect)
+        if not clipped.width or not clipped.height:
+            return []
+        size = self.tile_size
+        left = (clipped.left - self.rect.left) // size
+        right = (clipped.right - 1 - self.rect.left) // size
+        top = (clipped.top - self.rect.top) // size
+        bottom = (clipped.bottom - 1 - self.rect.top) // size
+        return [tile for row in self._grid[top:bottom + 1]
+                for tile in row[left:right + 1] if tile is not None]
+
+
+class TileLevel:
+    """A level stored as a header plus one JSON file per chunk, see save_level().
+
+    Chunks are read on demand as the camera advances and dropped again once
+    it has moved on, so only a few screens of the level are in memory.
+    """
+    def __init__(self, directory=DEFAULT_LEVEL, ahead=1):
+        self.directory = directory
+        self.ahead = ahead
+        with open(os.path.join(directory, 'level.json')) as f:
+            header = json.load(f)
+        if header.get('version') != LEVEL_VERSION:
+            raise ValueError('unsupported level version in %s' % directory)
+        self.tile_size = header['tile_size']
+        self.chunk_tiles = header['chunk_tiles']
+        self.origin_y = header['origin_y']
+        self.n_chunks = header['chunks']
+        self.start = tuple(header['start'])
+        self.chunk_width = self.chunk_tiles * self.tile_size
+        self.width = self.n_chunks * self.chunk_width
+        self.chunks = OrderedDict()  # index -> LevelChunk, loaded ones only
+        self.loads = 0
+
+    def _chunk_range(self, rect, ahead=0):
+        first = max(0, rect.left // self.chunk_width)
+        last = min(self.n_chunks - 1, (rect.right - 1) // self.chunk_width + ahead)
+        return range(first, last + 1)
+
+    def load_chunk(self, index):
+        chunk = self.chunks.get(index)
+        if chunk is None:
+            with open(os.path.join(self.directory, 'chunk_%04d.json' % index)) as f:
+                data = json.load(f)
+            chunk = self.chunks[index] = LevelChunk(index, index * self.chunk_width, self.origin_y,
+                                                    self.tile_size, data['tiles'], data['objects'])
+            self.loads += 1
+        return chunk
+
+    def stream(self, view):
+        """Load the chunks under view (plus `ahead` more) and unload the rest.
+
+        Returns the (loaded, unloaded) chunks so the caller can spawn and
+        despawn their objects.
+        """
+        wanted = self._chunk_range(view, self.ahead)
+        unloaded = [self.chunks.pop(index) for index in list(self.chunks) if index not in wanted]
+        loaded = [self.load_chunk(index) for index in wanted if index not in self.chunks]
+        return loaded, unloaded
+
+    def solids(self, rect):
+        """Solid tiles overlapping rect. Chunks that are not loaded have none."""
+        tiles = []
+        for index in self._chunk_range(rect):
+            chunk = self.chunks.get(index)
+            if chunk is not None:
+                tiles.extend(chunk.query(rect))
+        return tiles
+
+
+def save_level(directory, rows, objects=(), tile_size=32, chunk_tiles=16, origin_y=0,
+               start=(50, GROUND_LEVEL)):
+    """Split a full tile grid and object list into the files TileLevel reads.
+
+    rows are equal-length strings, one character per tile ('#' is solid);
+    objects are dicts with a 'type' and a world 'midbottom'. Each object is
+    stored with the chunk its midbottom falls in. start is the player's midbottom.
+    Raises ValueError for an object outside the grid's width.
+    """
+    width = len(rows[0])
+    n_chunks = -(-width // chunk_tiles)
+    chunk_width = chunk_tiles * tile_size
+    for o in objects:
+        if not 0 <= o['midbottom'][0] < n_chunks * chunk_width:
+            raise ValueError('%s at x=%s is outside the level (0-%d)'
+                             % (o['type'], o['midbottom'][0], n_chunks * chunk_width))
+    rows = [row.ljust(n_chunks * chunk_tiles, '.') for row in rows]
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'level.json'), 'w') as f:
+        json.dump({'version': LEVEL_VERSION, 'tile_size': tile_size, 'chunk_tiles': chunk_tiles,
+                   'origin_y': origin_y, 'chunks': n_chunks, 'start': list(start)}, f, indent=1)
+    for index in range(n_chunks):
+        start = index * chunk_tiles
+        chunk = {'tiles': [row[start:start + chunk_tiles] for row in rows],
+                 'objects': [o for o in objects if o['midbottom'][0] // chunk_width == index]}
+        with open(os.path.join(directory, 'chunk_%04d.json' % index), 'w') as f:
+            json.dump(chunk, f, indent=1)
+    return n_chunks
+
+
+LEVEL_OBJECTS = {'lucky_block': LuckyBlock}
+
+
+class Camera:
+    """World-space viewport. Sprites keep world rects; only drawing offsets them."""
+    def __init__(self, size, margin=64, world_width=None):
+        self.rect = pygame.Rect((0, 0), size)
+        self.margin = margin
+        self.world_width = world_width
+        self.previous_x = 0  # x before the last follow(), for interpolation
+
+    @property
+    def x(self):
+        return self.rect.x
+
+    def follow(self, target):
+        """Scroll right (never back) to keep target centred; returns how far we moved."""
+        self.previous_x = self.rect.x
+        move = max(0, target.centerx - self.rect.centerx)
+        if self.world_width is not None:
+            move = min(move, max(0, self.world_width - self.rect.right))
+        self.rect.x += move
+        return move
+
+    def lerp_x(self, alpha):
+        """x interpolated between the last two steps."""
+        return round(self.previous_x + (self.rect.x - self.previous_x) * alpha)
+
+    def view(self):
+        """The viewport grown by the culling margin."""
+        return self.rect.inflate(2 * self.margin, 2 * self.margin)
+
+
+class CameraGroup(pygame.sprite.LayeredDirty):
+    """LayeredDirty group that only holds what the camera can see.
+
+    World sprites are kept in a SpatialHash. Each frame the hash is queried
+    for the camera view, sprites entering it join the underlying LayeredDirty
+    group and sprites leaving it drop out, so drawing (and, unless
+    update_offscreen is set, updating) never touches the rest of the level.
+    Screen sprites, like the backdrop, are always drawn as they are. Call
+    moved() after moving a static world sprite; dynamic ones are rehashed
+    every frame. Pinned sprites, like the player, are updated even when
+    off-screen. draw() can interpolate dynamic sprites and the camera
+    between their last two steps, see GameLoop.
+    """
+    def __init__(self, camera, *screen_sprites, update_offscreen=False):
+        pygame.sprite.LayeredDirty.__init__(self, *screen_sprites)
+        self.camera = camera
+        self.update_offscreen = update_offscreen
+        self.world = SpatialHash()
+        self._screen_sprites = list(screen_sprites)
+        self._world_sprites = {}  # sprite -> dynamic flag
+        self._pinned = {}
+        self._shown = {}
+        self._previous = {}  # dynamic sprite -> topleft before the last update
+
+    def add_world(self, *sprites, dynamic=False, pinned=False):
+        for sprite in sprites:
+            self._world_sprites[sprite] = dynamic
+            if pinned:
+                self._pinned[sprite] = None
+            self.world.insert(sprite)
+
+    def remove_world(self, *sprites):
+        for sprite in sprites:
+            del self._world_sprites[sprite]
+            self._pinned.pop(sprite, None)
+            self._previous.pop(sprite, None)
+            self.world.remove(sprite)
+            if sprite in self._shown:
+                del self._shown[sprite]
+                self.remove(sprite)
+
+    def moved(self, sprite):
+        self.world.move(sprite)
+
+    def cull(self):
+        for sprite, dynamic in self._world_sprites.items():
+            if dynamic:
+                self.world.move(sprite)
+        shown = dict.fromkeys(self.world.query(self.camera.view()))
+        for sprite in self._shown:
+            if sprite not in shown:
+                self.remove(sprite)
+        for sprite in shown:
+            if sprite not in self._shown:
+                self.add(sprite)
+        self._shown = shown
+
+    def update(self, *args):
+        for sprite, dynamic in self._world_sprites.items():
+            if dynamic:
+                self._previous[sprite] = sprite.rect.topleft
+        self.cull()
+        for sprite in self._screen_sprites:
+            sprite.update(*args)
+        if self.update_offscreen:
+            active = self._world_sprites
+        else:
+            active = dict(self._pinned)
+            active.update(self._shown)
+        for sprite in active:
+            sprite.update(*args)
+
+    def _screen_rects(self, alpha):
+        # where each member goes on screen: world sprites offset by the camera,
+        # and interpolated when alpha < 1, screen sprites where they are
+        camera_x, camera_y = self.camera.lerp_x(alpha), self.camera.rect.y
+        rects = {}
+        for sprite in self._spritelist:
+            rect = sprite.rect
+            if sprite.source_rect is not None:
+                rect = pygame.Rect(rect.topleft, sprite.source_rect.size)
+            if sprite in self._shown:
+                dx, dy = -camera_x, -camera_y
+                previous = self._previous.get(sprite)
+                if previous is not None and alpha < 1.0:
+                    x, y = sprite.rect.topleft
+                    dx += round((previous[0] - x) * (1.0 - alpha))
+                    dy += round((previous[1] - y) * (1.0 - alpha))
+                rect = rect.move(dx, dy)
+                if not sprite.dirty and rect != self.spritedict[sprite]:
+                    sprite.dirty = 1  # moved on screen, e.g. only by interpolation
+            rects[sprite] = rect
+        return rects
+
+    def draw(self, surface, bgd=None, alpha=1.0):
+        """Dirty-rect draw like LayeredDirty's, blitting at screen positions.
+
+        World rects are never touched; spritedict keeps the screen rect each
+        sprite was last blitted to. Returns the changed screen rects.
+
+        This follows pygame 2.x's LayeredDirty.draw and relies on its private
+        _spritelist, _clip, _bgd and _init_rect attributes (checked by
+        TestCamera.testLayeredDirtyInternals); recheck it on pygame upgrades.
+        """
+        self.cull()
+        screen = self._screen_rects(alpha)
+        orig_clip = surface.get_clip()
+        clip = self._clip if self._clip is not None else orig_clip
+        surface.set_clip(clip)
+        if bgd is not None:
+            self._bgd = bgd
+        drawn = self.spritedict
+        update = self.lostsprites
+        for sprite in self._spritelist:
+            if sprite.dirty > 0:
+                _merge_rect(update, screen[sprite], clip)
+                if drawn[sprite] is not self._init_rect:
+                    _merge_rect(update, drawn[sprite], clip)
+        if self._bgd is not None:
+            for rect in update:
+                surface.blit(self._bgd, rect, rect)
+        for sprite in self._spritelist:
+            rect = screen[sprite]
+            if sprite.dirty > 0:
+                if sprite.visible:
+                    drawn[sprite] = surface.blit(sprite.image, rect, sprite.source_rect, sprite.blendmode)
+                if sprite.dirty == 1:
+                    sprite.dirty = 0
+            elif sprite.visible:
+                # not dirty: redraw only the parts uncovered by others
+                sx, sy = sprite.source_rect.topleft if sprite.source_rect is not None else (0, 0)
+                for i in rect.collidelistall(update):
+                    part = rect.clip(update[i])
+                    surface.blit(sprite.image, part, part.move(sx - rect.x, sy - rect.y), sprite.blendmode)
+        changed = list(update)
+        update[:] = []
+        surface.set_clip(orig_clip)
+        return changed
+
+
+def _merge_rect(rects, rect, clip):
+    # add rect to a list of disjoint dirty rects, absorbing those it touches
+    rect = pygame.Rect(rect)
+    i = rect.collidelist(rects)
+    while i > -1:
+        rect.union_ip(rects[i])
+        del rects[i]
+        i = rect.collidelist(rects)
+    rects.append(rect.clip(clip))
+
+
+_FULL_MASKS = {}
+
+
+def _full_mask(size):
+    mask = _FULL_MASKS.get(size)
+    if mask is None:
+        mask = _FULL_MASKS[size] = pygame.mask.Mask(size, fill=True)
+    return mask
+
+
+def pixels_overlap(a, b):
+    """Pixel test for two objects whose rects already overlap.
+
+    Objects without a mask attribute, like level tiles, count as solid
+    rects: the other mask is then only searched inside the overlap.
+    """
+    mask_a = getattr(a, 'mask', None)
+    mask_b = getattr(b, 'mask', None)
+    if mask_a is None and mask_b is None:
+        return True
+    if mask_a is None or mask_b is None:
+        masked, mask = (a, mask_a) if mask_a is not None else (b, mask_b)
+        clip = a.rect.clip(b.rect)
+        offset = (clip.x - masked.rect.x, clip.y - masked.rect.y)
+        return mask.overlap(_full_mask(clip.size), offset) is not None
+    return mask_a.overlap(mask_b, (b.rect.x - a.rect.x, b.rect.y - a.rect.y)) is not None
+
+
+def resolve_collision(sprite, solid):
+    # movement along one axis at the time, using the velocity to step back to
+    # where the sprite was before it overlapped; with no velocity on an axis
+    # (e.g. a wider animation frame) push out on the nearer side
+    dx = sprite.velocity[0]
+    dy = sprite.velocity[1]
+    t0_pos = sprite.rect.move((-dx, -dy))
+    if t0_pos.colliderect(solid.rect):
+        # the rects already overlapped through transparent mask pixels, so the
+        # step back says nothing about the way in: take the shallowest way out
+        _push_out(sprite, solid.rect)
+        return
+
+    test_pos = t0_pos.move((dx, 0))
+    if test_pos.colliderect(solid.rect):
+        if dx > 0 or (dx == 0 and sprite.rect.centerx < solid.rect.centerx):
+            sprite.rect.right = solid.rect.left
+        else:
+            sprite.rect.left = solid.rect.right
+
+        sprite.velocity[0] = 0
+
+    test_pos = t0_pos.move((0, dy))
+    if test_pos.colliderect(solid.rect):
+        if dy > 0 or (dy == 0 and sprite.rect.centery < solid.rect.centery):
+            sprite.rect.bottom = solid.rect.top
+        else:
+            sprite.rect.top = solid.rect.bottom
+
+        sprite.velocity[1] = 0
+
+
+def _push_out(sprite, other):
+    # move sprite's rect out of other along the axis it is least deep in, and
+    # stop it on that axis if it was heading further in
+    rect = sprite.rect
+    left, right = rect.right - other.left, other.right - rect.left
+    up, down = rect.bottom - other.top, other.bottom - rect.top
+    if min(left, right) < min(up, down):
+        if left < right:
+            rect.right = other.left
+            heading_in = sprite.velocity[0] > 0
+        else:
+            rect.left = other.right
+            heading_in = sprite.velocity[0] < 0
+        if heading_in:
+            sprite.velocity[0] = 0
+    else:
+        if up < down:
+            rect.bottom = other.top
+            heading_in = sprite.velocity[1] > 0
+        else:
+            rect.top = other.bottom
+            heading_in = sprite.velocity[1] < 0
+        if heading_in:
+            sprite.velocity[1] = 0
+
+
+REPLAY_MAGIC = b'AGRP'
+REPLAY_VERSION = 2  # 1 stored the action count in a byte, readable still
+_TRUNCATED = 'replay stream ends in the middle of a record'
+
+
+def _write_varint(out, value):
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_byte(data, pos):
+    if pos >= len(data):
+        raise ValueError(_TRUNCATED)
+    return data[pos], pos + 1
 
 
-class Game:
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte, pos = _read_byte(data, pos)
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+class InputRecorder:
+    """Records the actions fed to Game.step as a compact binary stream.
+
+    Each record is a varint count of idle frames, a varint count of actions
+    and the Action values applied on the next frame; runs of idle frames collapse
+    into the count, so a typical session is a few bytes per key press. A
+    record with no actions ends the stream and carries the trailing idle run.
+    """
     def __init__(self):
-        pygame.init()
+        self._data = bytearray(REPLAY_MAGIC)
+        self._data.append(REPLAY_VERSION)
+        self._idle = 0
+        self.frames = 0
+
+    def record(self, actions, n_frames=1):
+        self.frames += n_frames
+        if not actions:
+            self._idle += n_frames
+            return
+        _write_varint(self._data, self._idle)
+        _write_varint(self._data, len(actions))
+        self._data.extend(action.value for action in actions)
+        self._idle = n_frames - 1
+
+    def to_bytes(self):
+        data = bytearray(self._data)
+        _write_varint(data, self._idle)
+        data.append(0)
+        return bytes(data)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+
+
+class ReplayDriver:
+    """Feeds a recorded input stream back through Game.step at CPU speed."""
+    def __init__(self, data):
+        if len(data) <= len(REPLAY_MAGIC) or data[:len(REPLAY_MAGIC)] != REPLAY_MAGIC:
+            raise ValueError('not a replay')
+        self.version = data[len(REPLAY_MAGIC)]
+        if self.version not in (1, REPLAY_VERSION):
+            raise ValueError('unsupported replay version %d (expected 1 to %d)' % (self.version, REPLAY_VERSION))
+        self.data = data
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls(f.read())
+
+    def __iter__(self):
+        """Yields (idle frames, actions) pairs; the last one has no actions."""
+        data = self.data
+        pos = len(REPLAY_MAGIC) + 1
+        while True:
+            idle, pos = _read_varint(data, pos)
+            if self.version > 1:
+                count, pos = _read_varint(data, pos)
+            else:
+                count, pos = _read_byte(data, pos)
+            if pos + count > len(data):
+                raise ValueError(_TRUNCATED)
+            actions = [Action(value) for value in data[pos:pos + count]]
+            pos += count
+            yield idle, actions
+            if not count:
+                return
+
+    def play(self, game):
+        for idle, actions in self:
+            if idle:
+                game.step((), idle)
+            if actions:
+                game.step(actions)
+            if not game.going:
+                break
+        return game.frame
+
+
+class Game(Scene):
+    def __init__(self, render_mode=RenderMode.DIRTY, headless=False, profiler=None, recorder=None,
+                 level=DEFAULT_LEVEL):
+        self.headless = headless
+        self.recorder = recorder
+        self.profiler = profiler if profiler is not None else NullFrameProfiler()
+        # mixer and font start on first use, see init_mixer() and load_font()
+        with startup_section('pygame display init'):
+            self._init_display()
         pygame.mouse.set_visible(0)
-        self.screen = pygame.display.set_mode((600, 337))
+        with startup_section('set_mode'):
+            self.screen = pygame.display.set_mode((600, 337))
+        with startup_section('asset pack'):
+            load_asset_pack()
         self.area = self.screen.get_rect()
         self.clock = pygame.time.Clock()
-        self.level_backdrop = LevelBackdrop()
-        self.mario = Mario((50, GROUND_LEVEL))
-        self.lucky_block = LuckyBlock()
-        self.ground = Ground(GROUND_LEVEL)
-        self.allsprites = pygame.sprite.RenderPlain( self.level_backdrop, self.ground, self.mario, self.lucky_block,)
-        pygame.display.flip()
+        self.going = True
+        with startup_section('load assets'):
+            self._load_assets()
+        with startup_section('level backdrop'):
+            self.level_backdrop = LevelBackdrop()
+        with startup_section('level'):
+            self.level = TileLevel(level)
+        with startup_section('mario'):
+            self.mario = Mario(self.level.start)
+        with startup_section('audio'):
+            self.audio = AudioManager(enabled=not headless)
+            self.audio.preload(JUMP_SOUND)
+        self.mario.audio = self.audio
+        self.solids = SpatialHash()  # solid objects; the level's tiles are queried separately
+        self.render_mode = render_mode
+        self.camera = Camera(self.area.size, world_width=self.level.width)
+        self.allsprites = CameraGroup(self.camera, self.level_backdrop)
+        self.allsprites.add_world(self.mario, dynamic=True, pinned=True)
+        self._chunk_objects = {}
+        self._stream_level()
+        if not headless:
+            pygame.display.flip()
         self.paused = False
-        self.run()
-
-    def run(self):
-        going = True
-        while going:
-            self.clock.tick(60)
-
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    going = False
-                elif event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
-                    self.paused = 1 - self.paused
-                elif event.type == pygame.KEYDOWN and event.key == pygame.K_RIGHT:
-                    self.mario.run(1)
-                elif event.type == pygame.KEYDOWN and event.key == pygame.K_LEFT:
-                    self.mario.run(-1)
-                elif event.type == pygame.KEYDOWN and event.key == pygame.K_UP:
-                    self.mario.jump()
-                elif event.type == pygame.KEYDOWN and event.key == pygame.K_DOWN:
-                    self.mario.crouch()
-                elif event.type == pygame.KEYUP:
-                    self.mario.stop()
-
-            keys = pygame.key.get_pressed()
-
-            if not self.paused:
-                self.allsprites.update()
-
-                if self.mario.rect.colliderect(self.ground.rect):
-                    self.mario.rect.bottom = self.ground.rect.top
-                    self.mario.velocity[1] = 0
-
-                if self.mario.rect.colliderect(self.lucky_block.rect):
-                    t1_pos = self.mario.rect
-                    dx = self.mario.velocity[0]
-                    dy = self.mario.velocity[1]
-                    t0_pos = self.mario.rect.move((-dx, -dy))
-
-                    collision_direction = [0, 0] # where [1,0] means from the left, [-1,0] from the right etc.
-                    # movement along one axis at the time
-                    test_pos = t0_pos.move((dx, 0))
-                    if test_pos.colliderect(self.lucky_block.rect):
-                        if dx > 0:
-                            self.mario.rect.right = self.lucky_block.rect.left
-                        else:
-                            self.mario.rect.left = self.lucky_block.rect.right
-
-                        self.mario.velocity[0] = 0
-
-                    test_pos = t0_pos.move((0, dy))
-                    if test_pos.colliderect(self.lucky_block.rect):
-                        if dy > 0:
-                            self.mario.rect.bottom = self.lucky_block.rect.top
-                        else:
-                            self.mario.rect.top = self.lucky_block.rect.bottom
-
-                        self.mario.velocity[1] = 0
-
-
-                movebackdrop = min(0, self.area.centerx - self.mario.rect.centerx)
-                if movebackdrop < 0:
-                    self.level_backdrop.pan(movebackdrop)
-                    self.lucky_block.pan(movebackdrop)
-                    self.mario.rect.centerx = self.area.centerx
-
-                if self.mario.rect.left < self.area.left:
-                    self.mario.rect.left = self.area.left
-
-
-
-
-                self.allsprites.draw(self.screen)
+        self.frame = 0
+        self.collisions = 0
+        self.input = InputMap(KEY_BINDINGS, HELD_KEYS, release=Action.STOP)
+        self._inputs = []  # actions from events, applied on the next update
+
+    def _init_display(self):
+        """Start the display, on SDL's dummy video driver when headless.
+
+        The dummy driver still gives us a display surface to convert() against.
+        It can only be picked before the display is initialised, so a headless
+        Game created while a real display is up keeps using that one.
+        SDL_VIDEODRIVER is restored once SDL has read it. Headless games never
+        start the mixer, so the audio driver is left alone.
+        """
+        if not self.headless or pygame.display.get_init():
+            pygame.display.init()
+            return
+        previous = os.environ.get('SDL_VIDEODRIVER')
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        try:
+            pygame.display.init()
+        finally:
+            if previous is None:
+                del os.environ['SDL_VIDEODRIVER']
+            else:
+                os.environ['SDL_VIDEODRIVER'] = previous
+
+    def _load_assets(self):
+        """Decode the start-up art in the background while a progress bar is shown."""
+        loader = AssetLoader()
+        loader.image(BACKDROP_IMAGE)
+        loader.image(LUCKY_BLOCK_IMAGE, (250, 250, 250))
+        for frames in IMAGES_DICT[CharacterStyle.BIG].values():
+            for filename in frames:
+                loader.image(filename, -1, CharacterStyle.BIG)
+        while loader.pump(timeout=1 / 60):
+            if not self.headless:
+                draw_loading_screen(self.screen, loader.progress())
                 pygame.display.flip()
+            if pygame.event.get(pygame.QUIT):
+                self.going = False
+        loader.shutdown()
 
+    def run(self):
+        self.input.allow_events()
+        GameLoop(self, profiler=self.profiler, clock=self.clock).run()
         pygame.quit()
+
+    @property
+    def running(self):
+        return self.going
+
+    def handle_events(self, events):
+        self._inputs.extend(self.input.actions(events))
+
+    def update(self):
+        inputs, self._inputs = self._inputs, []
+        self.step(inputs)
+
+    def draw(self, alpha):
+        if not self.paused and not self.headless:
+            self.render(alpha)
+            finish_startup()
+            if not self.audio.started:
+                # sound comes up once the first frame is on screen
+                self.audio.start()
+                self.audio.play_music(THEME_MUSIC)
+
+    def apply_action(self, action):
+        if action == Action.QUIT:
+            self.going = False
+        elif action == Action.PAUSE:
+            self.paused = 1 - self.paused
+        elif action == Action.RIGHT:
+            self.mario.run(1)
+        elif action == Action.LEFT:
+            self.mario.run(-1)
+        elif action == Action.JUMP:
+            self.mario.jump()
+        elif action == Action.CROUCH:
+            self.mario.crouch()
+        elif action == Action.STOP:
+            self.mario.stop()
+
+    def step(self, inputs=(), n_frames=1):
+        """Apply inputs, then advance the simulation n_frames fixed timesteps.
+
+        Nothing is drawn and the clock is not consulted, so this runs as fast
+        as the CPU allows. Returns the total number of frames simulated.
+        """
+        if self.recorder is not None:
+            self.recorder.record(inputs, n_frames)
+        for action in inputs:
+            self.apply_action(action)
+        for _ in range(n_frames):
+            if self.paused:
+                break
+            self._simulate()
+            self.frame += 1
+        return self.frame
+
+    def snapshot(self):
+        return (self.frame, tuple(self.mario.rect), tuple(self.mario.velocity),
+                self.mario.state, self.camera.x)
+
+    def _simulate(self):
+        self.allsprites.update()
+        self.profiler.lap('update')
+
+        self._collide(self.mario)
+        self.profiler.lap('collision')
+
+        if self.camera.follow(self.mario.rect):
+            self._stream_level()
+
+        if self.mario.rect.left < self.camera.rect.left:
+            self.mario.rect.left = self.camera.rect.left
+        if self.mario.rect.right > self.level.width:
+            self.mario.rect.right = self.level.width
+        self.profiler.lap('pan')
+
+    def level_objects(self, kind=object):
+        """The objects of the currently loaded chunks that are instances of kind, in world order."""
+        return [o for index in sorted(self._chunk_objects)
+                for o in self._chunk_objects[index] if isinstance(o, kind)]
+
+    def _stream_level(self):
+        loaded, unloaded = self.level.stream(self.camera.view())
+        for chunk in unloaded:
+            for obj in self._chunk_objects.pop(chunk.index):
+                self.allsprites.remove_world(obj)
+                self.solids.remove(obj)
+        for chunk in loaded:
+            objects = self._chunk_objects[chunk.index] = [
+                LEVEL_OBJECTS[o['type']](tuple(o['midbottom'])) for o in chunk.objects]
+            for obj in objects:
+                self.allsprites.add_world(obj)
+                self.solids.insert(obj)
+
+    def _collide(self, sprite):
+        # broad phase over the swept rect, then the axis-separated narrow phase
+        swept = sprite.rect.union(sprite.rect.move((-sprite.velocity[0], -sprite.velocity[1])))
+        for solid in self.level.solids(swept) + self.solids.query(swept):
+            if sprite.rect.colliderect(solid.rect) and pixels_overlap(sprite, solid):
+                resolve_collision(sprite, solid)
+                self.collisions += 1
+        # standing on a solid cancels the gravity added this frame, so a grounded
+        # sprite never looks airborne to run() and stop()
+        if sprite.velocity[1] > 0:
+            feet = pygame.Rect(sprite.rect.left, sprite.rect.bottom, sprite.rect.width, 1)
+            for solid in self.level.solids(feet) + self.solids.query(feet):
+                if feet.colliderect(solid.rect):
+                    sprite.velocity[1] = 0
+                    break
+
+    def render(self, alpha=1.0):
+        self.level_backdrop.scroll_to(self.camera.lerp_x(alpha))
+        if self.render_mode != RenderMode.DIRTY:
+            self.allsprites.repaint_rect(self.area)
+            self.allsprites.draw(self.screen, alpha=alpha)
+            self._draw_overlay()
+            self.profiler.lap('draw')
+            pygame.display.flip()
+            self.profiler.lap('present')
+            return
+
+        # a panned backdrop invalidates the whole screen, so fall back to a full flip
+        full_redraw = self.level_backdrop.dirty
+        self.mario.refresh_dirty()
+        rects = self.allsprites.draw(self.screen, alpha=alpha)
+        overlay = self._draw_overlay()
+        if overlay is not None:
+            rects.append(overlay)
+            self.allsprites.repaint_rect(overlay)  # uncover it again next frame
+        self.profiler.lap('draw')
+        if full_redraw:
+            pygame.display.flip()
+        else:
+            pygame.display.update(rects)
+        self.profiler.lap('present')
+
+    def _draw_overlay(self):
+        if not self.profiler.overlay:
+            return None
+        font = load_font(None, 16)
+        if font is None:
+            return None
+        return self.profiler.draw_overlay(self.screen, font)
+
+
+class StressScene(Scene):
+    """Hundreds of characters running across the screen, spawned from pools.
+
+    Characters of every style appear at random, run for an edge, jump now
+    and then and are recycled once off-screen. New ones are spawned every
+    update to keep count of them alive. Physics runs in one PhysicsBatch.
+    render_mode picks dirty-rect or full-screen presentation, as for Game.
+    Run it with main.py --stress N [--flip].
+    """
+    def __init__(self, count=300, styles=(CharacterStyle.BIG, CharacterStyle.FIRE), seed=0,
+                 profiler=None, render_mode=RenderMode.DIRTY):
+        self.screen = pygame.display.get_surface()
+        self.area = self.screen.get_rect()
+        self.count = count
+        self.render_mode = render_mode
+        self.profiler = profiler if profiler is not None else NullFrameProfiler()
+        self.rng = random.Random(seed)
+        self.batch = PhysicsBatch(capacity=count)
+        per_pool = -(-count // len(styles))
+        self.pools = [CharacterPool(style, per_pool, batch=self.batch) for style in styles]
+        self.backdrop = LevelBackdrop()
+        self.sprites = pygame.sprite.LayeredDirty(self.backdrop)
+
+    def handle_event(self, event):
+        if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+            self.running = False
+
+    def _spawn(self):
+        # only pools with a sprite to spare, so nothing is created during play
+        pool = self.rng.choice([pool for pool in self.pools if pool.free] or self.pools)
+        direction = self.rng.choice((1, -1))
+        sprite = pool.spawn((self.rng.randrange(self.area.width), GROUND_LEVEL), direction)
+        sprite.run(direction)
+        sprite.dirty = 2
+        self.sprites.add(sprite)
+
+    def update(self):
+        while len(self.batch) < self.count:
+            self._spawn()
+        area = self.area
+        chance = self.rng.random
+        for pool in self.pools:
+            for sprite in list(pool.active):
+                if not area.colliderect(sprite.rect):
+                    pool.despawn(sprite)
+                elif sprite.velocity[1] == 0 and chance() < 0.01:
+                    sprite.jump()
+        self.sprites.update()
+        self.batch.step(self.area)
+        self.profiler.lap('update')
+
+    def draw(self, alpha):
+        if self.render_mode != RenderMode.DIRTY:
+            self.sprites.repaint_rect(self.area)
+        rects = self.sprites.draw(self.screen)
+        overlay = None
+        if self.profiler.overlay:
+            font = load_font(None, 16)
+            if font is not None:
+                overlay = self.profiler.draw_overlay(self.screen, font)
+        self.profiler.lap('draw')
+        if self.render_mode != RenderMode.DIRTY:
+            pygame.display.flip()
+        else:
+            if overlay is not None:
+                rects.append(overlay)
+                self.sprites.repaint_rect(overlay)  # uncover it again next frame
+            pygame.display.update(rects)
+        self.profiler.lap('present')
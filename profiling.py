@@ -0,0 +1,200 @@
+"""Timing instrumentation for startup and frame profiling."""
+import csv
+import json
+import sys
+import time
+from array import array
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+
+class StartupProfiler:
+    """Time breakdown from process start to the first presented frame.
+
+    Sections nest; the report lists them in start order, indented by depth,
+    with their offset from when the profiler was created and their duration.
+    """
+    def __init__(self, stream=None):
+        self.started = time.perf_counter()
+        self.stream = stream if stream is not None else sys.stderr
+        self.records = []  # (start offset, duration, depth, name)
+        self._depth = 0
+
+    @contextmanager
+    def section(self, name):
+        start = time.perf_counter()
+        depth = self._depth
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth = depth
+            self.records.append((start - self.started, time.perf_counter() - start, depth, name))
+
+    def mark(self, name):
+        self.records.append((time.perf_counter() - self.started, 0.0, self._depth, name))
+
+    def report(self):
+        lines = ['  offset ms     took ms  section']
+        for offset, duration, depth, name in sorted(self.records, key=lambda r: (r[0], r[2])):
+            lines.append('%10.2f  %10.2f  %s%s' % (offset * 1000, duration * 1000, '  ' * depth, name))
+        return '\n'.join(lines)
+
+
+_startup_profiler = None
+
+
+def install_startup_profiler(stream=None):
+    global _startup_profiler
+    _startup_profiler = StartupProfiler(stream)
+    return _startup_profiler
+
+
+def startup_section(name):
+    if _startup_profiler is None:
+        return nullcontext()
+    return _startup_profiler.section(name)
+
+
+def finish_startup():
+    """Mark the first presented frame and print the startup report, once."""
+    global _startup_profiler
+    if _startup_profiler is not None:
+        profiler, _startup_profiler = _startup_profiler, None
+        profiler.mark('first frame presented')
+        print(profiler.report(), file=profiler.stream)
+
+
+class FrameProfiler:
+    """Per-phase frame timings kept in fixed-size ring buffers.
+
+    Call begin_frame() with the clock.tick() result, lap(phase) as each phase
+    of the frame finishes and end_frame() once it is presented. Frames whose
+    tick exceeds the frame budget by more than drop_tolerance are flagged as
+    dropped. Timings are stored in milliseconds.
+    """
+    PHASES = ('events', 'update', 'collision', 'pan', 'draw', 'present')
+
+    def __init__(self, capacity=600, target_fps=60, drop_tolerance=1.5, overlay=False):
+        self.capacity = capacity
+        self.budget_ms = 1000.0 / target_fps
+        self.drop_tolerance = drop_tolerance
+        self.overlay = overlay
+        self.columns = self.PHASES + ('total', 'tick')
+        self._samples = {column: array('d', bytes(8 * capacity)) for column in self.columns}
+        self._frames = array('q', bytes(8 * capacity))
+        self.count = 0
+        self.dropped = deque(maxlen=capacity)  # (frame, tick ms, work ms)
+        self.dropped_total = 0
+        self._current = None
+        self._start = self._last = 0.0
+
+    def begin_frame(self, tick_ms=None):
+        self._current = dict.fromkeys(self.PHASES, 0.0)
+        self._current['tick'] = tick_ms if tick_ms is not None else 0.0
+        self._start = self._last = time.perf_counter()
+
+    def lap(self, phase):
+        if self._current is None:
+            return
+        now = time.perf_counter()
+        self._current[phase] += (now - self._last) * 1000
+        self._last = now
+
+    def end_frame(self):
+        current, self._current = self._current, None
+        if current is None:
+            return
+        current['total'] = (time.perf_counter() - self._start) * 1000
+        slot = self.count % self.capacity
+        for column in self.columns:
+            self._samples[column][slot] = current[column]
+        self._frames[slot] = self.count
+        if current['tick'] > self.budget_ms * self.drop_tolerance:
+            self.dropped.append((self.count, current['tick'], current['total']))
+            self.dropped_total += 1
+        self.count += 1
+
+    def _ordered(self, data):
+        if self.count <= self.capacity:
+            return list(data[:self.count])
+        slot = self.count % self.capacity
+        return list(data[slot:]) + list(data[:slot])
+
+    def samples(self, column):
+        """Recorded values of one column, oldest first."""
+        return self._ordered(self._samples[column])
+
+    def frame_numbers(self):
+        return self._ordered(self._frames)
+
+    def percentiles(self, column, percents=(50, 95, 99)):
+        values = sorted(self.samples(column))
+        if not values:
+            return [0.0 for _ in percents]
+        return [values[min(len(values) - 1, int(len(values) * p / 100))] for p in percents]
+
+    def summary(self):
+        return {'frames': self.count,
+                'dropped': self.dropped_total,
+                'budget_ms': self.budget_ms,
+                'percentiles': {column: dict(zip(('p50', 'p95', 'p99'), self.percentiles(column)))
+                                for column in self.columns},
+                }
+
+    def rows(self):
+        frames = self.frame_numbers()
+        columns = [self.samples(column) for column in self.columns]
+        dropped = {frame for frame, _, _ in self.dropped}
+        for i, frame in enumerate(frames):
+            yield [frame] + [column[i] for column in columns] + [int(frame in dropped)]
+
+    def to_csv(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('frame',) + self.columns + ('dropped',))
+            writer.writerows(self.rows())
+
+    def to_json(self, path):
+        header = ('frame',) + self.columns + ('dropped',)
+        with open(path, 'w') as f:
+            json.dump({'summary': self.summary(),
+                       'frames': [dict(zip(header, row)) for row in self.rows()]}, f, indent=1)
+
+    def dump(self, path):
+        if path.endswith('.json'):
+            self.to_json(path)
+        else:
+            self.to_csv(path)
+
+    def overlay_lines(self):
+        tick = self.percentiles('tick', (50,))[0]
+        lines = ['%5.1f fps  dropped %d' % (1000.0 / tick if tick else 0.0, self.dropped_total)]
+        for column in self.PHASES + ('total',):
+            lines.append('%-9s %6.2f %6.2f %6.2f' % ((column,) + tuple(self.percentiles(column))))
+        return lines
+
+    def draw_overlay(self, surface, font):
+        """Blit the rolling p50/p95/p99 table onto surface; returns the rect covered."""
+        import pygame
+        lines = [font.render(line, 1, (255, 255, 255)) for line in self.overlay_lines()]
+        height = font.get_linesize()
+        rect = pygame.Rect(4, 4, max(line.get_width() for line in lines) + 8, height * len(lines) + 8)
+        surface.fill((0, 0, 0), rect)
+        for i, line in enumerate(lines):
+            surface.blit(line, (rect.x + 4, rect.y + 4 + i * height))
+        return rect
+
+
+class NullFrameProfiler:
+    """Stands in for FrameProfiler when frame profiling is off."""
+    overlay = False
+
+    def begin_frame(self, tick_ms=None):
+        pass
+
+    def lap(self, phase):
+        pass
+
+    def end_frame(self):
+        pass
@@ -1,5 +1,12 @@
+import os
 import unittest
+import tempfile
+import io
+import json
 import pygame
+import profiling
+import batch
+from engine import AssetPack, TransformCache
 from mygameslib import *
 
 
@@ -10,24 +17,29 @@ class TestMarioBase(unittest.TestCase):
 
     def testInit(self):
         self.assertTrue(isinstance(self.mario, Mario))
-        self.assertEqual(self.mario.state, CHARACTER_STATES.stopped)
+        self.assertEqual(self.mario.state, CharacterState.STOPPED)
 
     def tearDown(self):
         pygame.quit()
 
 class TestMarioStates(TestMarioBase):
+    def setUp(self):
+        # a headless game supplies the level's ground for Mario to run on
+        self.game = Game(headless=True)
+        self.mario = self.game.mario
+
     def testRunBasic(self):
         pos = self.mario.rect.midbottom
         self.mario.run(1)
         # running sets velocity and updates the image
         self.assertEqual(self.mario.velocity, [self.mario.running_speed, 0])
-        self.assertEqual(self.mario.state, CHARACTER_STATES.running)
-        self.mario.update()
-        self.assertEqual(self.mario.image, self.mario._images[CHARACTER_STATES.running][0])
+        self.assertEqual(self.mario.state, CharacterState.RUNNING)
+        self.game.step()
+        self.assertEqual(self.mario.image, self.mario._images[CharacterState.RUNNING][0])
         # after one update, the position should have updated, and the velocity should remain unchanged
         self.assertEqual(self.mario.velocity, [self.mario.running_speed, 0])
         self.assertEqual(self.mario.rect.midbottom, (pos[0] + self.mario.running_speed, pos[1]))
-        self.mario.update()
+        self.game.step()
         self.assertEqual(self.mario.rect.midbottom, (pos[0] + 2*self.mario.running_speed, pos[1]))
 
     def testChangeDirection(self):
@@ -37,31 +49,64 @@ class TestMarioStates(TestMarioBase):
         self.mario.direction = -1
         self.assertNotEqual(img, self.mario.image)
 
+    def testDirectionReusesFrames(self):
+        img = self.mario.image
+        self.mario.direction = -1
+        flipped = self.mario.image
+        self.assertEqual(flipped.get_parent(), img.get_parent())
+        self.mario.direction = 1
+        self.assertIs(img, self.mario.image)
+        self.mario.direction = -1
+        self.assertIs(flipped, self.mario.image)
+
+    def testAnimationSchedule(self):
+        running = self.mario._images[CharacterState.RUNNING]
+        self.mario.run(1)
+        frames = []
+        for _ in range(7):
+            self.game.step()
+            frames.append(running.index(self.mario.image))
+        self.assertEqual(frames, [0, 1, 1, 2, 2, 0, 0])
+        self.mario.state = CharacterState.STOPPED
+        self.assertIs(self.mario.image, self.mario._images[CharacterState.STOPPED][0])
+
+    def testAnimationTable(self):
+        table = AnimationTable({CharacterState.RUNNING: 3, CharacterState.JUMPING: 1},
+                               {CharacterState.RUNNING: 3, CharacterState.JUMPING: 5})
+        self.assertEqual(table.schedules[CharacterState.RUNNING], (0, 0, 0, 1, 1, 1, 2, 2, 2))
+        self.assertEqual(table.schedules[CharacterState.JUMPING], (0,))
+        self.assertEqual(table.frame_index(CharacterState.RUNNING, 10), 0)
+
+    def testRefreshDirty(self):
+        self.mario.refresh_dirty()
+        self.mario.dirty = 0
+        self.mario.refresh_dirty()
+        self.assertEqual(self.mario.dirty, 0)
+        self.mario.rect.move_ip(1, 0)
+        self.mario.refresh_dirty()
+        self.assertEqual(self.mario.dirty, 1)
+
     def testRunDirection(self):
         pos = self.mario.rect.midbottom
         self.mario.run(-1)
-        self.mario.update()
+        self.game.step()
         self.assertEqual(self.mario.rect.midbottom, (pos[0] - self.mario.running_speed, pos[1]))
         self.mario.run(1)
-        self.mario.update()
+        self.game.step()
         self.assertEqual(self.mario.rect.midbottom, (pos[0], pos[1]))
 
     def testRunCycle(self):
+        running = self.mario._images[CharacterState.RUNNING]
         self.mario.run(1)
-        self.mario.update()
-        self.assertEqual(self.mario.image, self.mario._images[CHARACTER_STATES.running][0])
-        self.mario.update()
-        self.assertEqual(self.mario.image, self.mario._images[CHARACTER_STATES.running][1])
-        self.mario.update()
-        self.assertEqual(self.mario.image, self.mario._images[CHARACTER_STATES.running][2])
-        self.mario.update()
-        self.assertEqual(self.mario.image, self.mario._images[CHARACTER_STATES.running][0])
+        for index in (0, 1, 1, 2, 2, 0):
+            self.game.step()
+            self.assertIs(self.mario.image, running[index])
 
     def testJumpBasic(self):
         self.mario.jump()
-        self.assertEqual(self.mario.state, CHARACTER_STATES.jumping)
+        self.assertEqual(self.mario.state, CharacterState.JUMPING)
         self.assertEqual(self.mario.velocity[1], -self.mario.jumping_speed)
-        self.mario.update()
+        self.game.step()
         self.assertEqual(self.mario.velocity[1], -(self.mario.jumping_speed - GRAVITY))
 
         # lands on the ground
@@ -70,19 +115,962 @@ class TestMarioStates(TestMarioBase):
         while self.mario.rect.bottom < GROUND_LEVEL:
             if nupdates >= maxupdates:
                 break
-            self.mario.update()
+            self.game.step()
             nupdates += 1
 
         self.assertEqual(self.mario.rect.bottom, GROUND_LEVEL)
-        self.assertEqual(self.mario.state, CHARACTER_STATES.stopped)
+        self.assertEqual(self.mario.state, CharacterState.STOPPED)
 
     def testRunningJump(self):
         self.mario.run(1)
-        self.mario.update()
+        self.game.step()
         self.mario.jump()
-        self.mario.update()
+        self.game.step()
         self.assertEqual(self.mario.velocity, [self.mario.running_speed, -(self.mario.jumping_speed - GRAVITY)])
 
+class TestAssetCache(unittest.TestCase):
+    def setUp(self):
+        self.screen = pygame.display.set_mode((600, 337))
+        self.cache = AssetCache(max_entries=2)
+
+    def testHitsAndMisses(self):
+        img = self.cache.get_image('mario0.png', -1, CharacterStyle.BIG)
+        self.assertIs(img, self.cache.get_image('mario0.png', -1, CharacterStyle.BIG))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.cache.get_image('mario0.png', None, CharacterStyle.BIG)
+        self.assertEqual(self.cache.misses, 2)
+
+    def testEviction(self):
+        self.cache.get_image('mario0.png')
+        self.cache.get_image('mario1.png')
+        self.cache.get_image('mario0.png')
+        self.cache.get_image('mario2.png')
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertNotIn(('mario1.png', None, None), self.cache)
+        self.assertIn(('mario0.png', None, None), self.cache)
+
+    def testByteBound(self):
+        img = self.cache.get_image('mario0.png')
+        self.cache.max_bytes = img.get_pitch() * img.get_height()
+        self.cache.get_image('mario1.png')
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.stats()['bytes'], self.cache.max_bytes)
+
+    def testMarioSharesFrames(self):
+        ASSET_CACHE.reset_stats()
+        Mario((50, GROUND_LEVEL))
+        misses = ASSET_CACHE.misses
+        Mario((50, GROUND_LEVEL))
+        self.assertEqual(ASSET_CACHE.misses, misses)
+        self.assertGreater(ASSET_CACHE.hits, 0)
+
+    def tearDown(self):
+        pygame.quit()
+
+class TestAssetLoader(unittest.TestCase):
+    def setUp(self):
+        self.screen = pygame.display.set_mode((600, 337))
+        self.cache = AssetCache()
+        self.loader = AssetLoader(workers=2, cache=self.cache)
+
+    def testResolve(self):
+        future = self.loader.image('mario0.png', -1, CharacterStyle.BIG)
+        self.assertIs(future, self.loader.image('mario0.png', -1, CharacterStyle.BIG))
+        resolved = []
+        future.add_done_callback(resolved.append)
+        image = future.result()
+        self.assertEqual(resolved, [image])
+        self.assertIs(image, self.cache.get_image('mario0.png', -1, CharacterStyle.BIG))
+        self.assertIsNotNone(image.get_colorkey())
+
+    def testPump(self):
+        names = ['mario%d.png' % i for i in range(7)]
+        futures = [self.loader.image(name) for name in names]
+        while self.loader.pump(timeout=0.1):
+            pass
+        self.assertTrue(all(f.done() for f in futures))
+        self.assertEqual(self.loader.progress(), 1.0)
+        self.assertEqual(len(self.cache), 7)
+
+    def testCachedIsDone(self):
+        self.cache.get_image('mario0.png')
+        self.assertTrue(self.loader.image('mario0.png').done())
+
+    def tearDown(self):
+        self.loader.shutdown()
+        pygame.quit()
+
+
+class TestTransformCache(unittest.TestCase):
+    def setUp(self):
+        self.screen = pygame.display.set_mode((600, 337))
+        self.cache = TransformCache()
+        self.image = load_image('mario0.png', -1)
+
+    def testRotations(self):
+        table = self.cache.rotations(self.image)
+        self.assertEqual(len(table), 30)
+        self.assertIs(table[0][0], self.image)
+        image, rect = table[5]
+        self.assertEqual(rect.size, image.get_size())
+        self.assertEqual(rect.center, (0, 0))
+        self.assertIs(table, self.cache.rotations(self.image))
+        self.assertIs(self.cache.rotated(self.image, 61)[0], image)
+        self.assertIs(self.cache.rotated(self.image, 359)[0], self.image)
+        self.assertEqual((self.cache.hits, self.cache.misses), (3, 1))
+
+    def testFlipAndScale(self):
+        flipped = self.cache.flipped(self.image)
+        self.assertIs(flipped, self.cache.flipped(self.image))
+        self.assertIs(self.cache.flipped(self.image, False), self.image)
+        self.assertEqual(flipped.get_at((0, 0)), self.image.get_at((self.image.get_width() - 1, 0)))
+        self.assertEqual(self.cache.scaled(self.image, (10, 20)).get_size(), (10, 20))
+
+    def testEntriesDieWithSource(self):
+        self.cache.flipped(self.image)
+        self.assertEqual(len(self.cache._entries), 1)
+        del self.image
+        self.assertEqual(len(self.cache._entries), 0)
+
+    def tearDown(self):
+        pygame.quit()
+
+
+class TestPhysicsBatch(unittest.TestCase):
+    def setUp(self):
+        self.screen = pygame.display.set_mode((600, 337))
+        self.batch = PhysicsBatch(capacity=2)
+        self.marios = [Mario((50 + 40 * i, GROUND_LEVEL)) for i in range(3)]
+        for mario in self.marios:
+            self.batch.add(mario)
+
+    def testVelocityIsView(self):
+        self.marios[2].run(1)
+        self.assertEqual(self.batch.velocity[2, 0], self.marios[2].running_speed)
+        self.assertEqual(self.batch.state[2], CharacterState.RUNNING.value)
+
+    def testJumpAndLand(self):
+        mario = self.marios[1]
+        mario.run(1)
+        mario.jump()
+        self.batch.step()
+        self.assertLess(mario.rect.bottom, GROUND_LEVEL)
+        self.assertEqual(mario.velocity[1], -(mario.jumping_speed - GRAVITY))
+        for _ in range(100):
+            self.batch.step()
+        self.assertEqual(mario.rect.bottom, GROUND_LEVEL)
+        self.assertEqual(mario.velocity[1], 0)
+        self.assertEqual(mario.state, CharacterState.RUNNING)
+        self.assertEqual(self.marios[0].rect.midbottom, (50, GROUND_LEVEL))
+
+    def testRectsFollowFrames(self):
+        self.marios[0].run(1)
+        for _ in range(5):
+            for mario in self.marios:
+                mario.update()
+            self.batch.step()
+        for i, mario in enumerate(self.marios):
+            self.assertEqual(mario.rect, mario.image.get_rect(midbottom=self.batch.position[i].astype(int)))
+
+    def testViewSkipsHiddenRects(self):
+        view = pygame.Rect(0, 0, 100, 337)  # holds marios[0] at x=50 only
+        self.marios[0].run(1)
+        self.marios[2].run(1)
+        self.batch.step(view)
+        far = self.marios[2].rect.copy()
+        for _ in range(10):
+            self.batch.step(view)
+        self.assertEqual(self.marios[2].rect, far)
+        self.assertEqual(self.marios[0].rect.centerx, 50 + 11 * self.marios[0].running_speed)
+        # marios[0] walks out of the view: its rect is written once more, outside
+        for _ in range(20):
+            self.batch.step(view)
+        self.assertFalse(view.colliderect(self.marios[0].rect))
+
+    def testRemove(self):
+        velocity = self.batch._own[self.marios[0]][0]
+        self.marios[0].run(1)
+        self.marios[2].run(-1)
+        self.batch.remove(self.marios[0])
+        self.assertEqual(len(self.batch), 2)
+        # the sprite gets its own list back, refilled with the batched values
+        self.assertIs(self.marios[0].velocity, velocity)
+        self.assertEqual(self.marios[0].velocity, [self.marios[0].running_speed, 0])
+        self.assertEqual(self.marios[0].acceleration, (0, GRAVITY))
+        self.marios[2].stop()
+        self.assertEqual(self.batch.velocity[0, 0], 0)
+        self.assertEqual(self.batch.sprites, [self.marios[2], self.marios[1]])
+
+    def tearDown(self):
+        pygame.quit()
+
+
+class TestLevelBackdrop(unittest.TestCase):
+    def setUp(self):
+        self.screen = pygame.display.set_mode((600, 337))
+        self.source = load_cached_image('supermariobackground.jpg')
+
+    def testPanShowsOffsetTiles(self):
+        backdrop = LevelBackdrop()
+        backdrop.pan(-650)
+        self.assertEqual(backdrop.rect.size, self.screen.get_size())
+        self.assertEqual(backdrop.image.get_at((0, 100)), self.source.get_at((50, 100)))
+        self.assertEqual(backdrop.image.get_at((560, 100)), self.source.get_at((10, 100)))
+
+    def testChunkedSource(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        directory = tmp.name
+        self.assertEqual(split_backdrop('supermariobackground.jpg', directory, 100), 6)
+        source = ChunkedTileSource(directory, cache_tiles=4)
+        backdrop = LevelBackdrop(source)
+        backdrop.pan(-150)
+        self.assertEqual(backdrop.image.get_at((0, 100)), self.source.get_at((150, 100)))
+        self.assertLessEqual(len(source._cache), 4)
+        backdrop.pan(-400)
+        self.assertEqual(backdrop.image.get_at((599, 100)), (0, 0, 0, 255))
+
+    def tearDown(self):
+        pygame.quit()
+
+
+class TestImagePipeline(unittest.TestCase):
+    def setUp(self):
+        self.screen = pygame.display.set_mode((600, 337))
+        self.image = load_image('mario1.png')
+
+    def testRepeatSurface(self):
+        repeated = repeat_surface(self.image, 3)
+        width = self.image.get_width()
+        self.assertEqual(repeated.get_size(), (3 * width, self.image.get_height()))
+        self.assertEqual(repeated.get_at((2 * width + 10, 20)), self.image.get_at((10, 20)))
+
+    def testFlipInPlace(self):
+        flipped = flip_in_place(self.image.copy())
+        width = self.image.get_width()
+        self.assertEqual(flipped.get_at((width - 11, 20)), self.image.get_at((10, 20)))
+
+    def testFlipUnconvertedJpg(self):
+        image = pygame.image.load(os.path.join(DATA_DIR, BACKDROP_IMAGE))
+        self.assertEqual(image.get_bytesize(), 3)
+        flipped = flip_in_place(image.copy())
+        width = image.get_width()
+        self.assertEqual(flipped.get_at((width - 11, 20)), image.get_at((10, 20)))
+        self.assertEqual(flipped.get_at((10, 20)), image.get_at((width - 11, 20)))
+
+    def testPilRoundTrip(self):
+        image = surface_to_pil(self.image)
+        self.assertEqual(image.size, self.image.get_size())
+        self.assertEqual(image.getpixel((10, 20))[:3], tuple(self.image.get_at((10, 20)))[:3])
+        surface = pil_to_surface(image)
+        self.assertEqual(surface.get_at((10, 20))[:3], self.image.get_at((10, 20))[:3])
+
+    def testPreprocess(self):
+        image = preprocess_image(self.image.copy(), repeat=2, flip=True, colorkey=-1)
+        self.assertEqual(image.get_width(), 2 * self.image.get_width())
+        self.assertEqual(image.get_colorkey(), self.image.get_at((0, 0)))
+
+    def tearDown(self):
+        pygame.quit()
+
+
+class TestAssetPack(unittest.TestCase):
+    def setUp(self):
+        import bake_assets
+        self.screen = pygame.display.set_mode((600, 337))
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'assets.pack')
+        bake_assets.bake(self.path)
+        self.pack = AssetPack(self.path)
+        self.addCleanup(self.pack.close)
+
+    def testImagesMatchFiles(self):
+        for name in ('mario1.png', BACKDROP_IMAGE, 'chimp.bmp'):
+            self.assertIn(name, self.pack)
+            baked = self.pack.image(name).convert()
+            loaded = load_image(name)
+            self.assertEqual(baked.get_size(), loaded.get_size())
+            self.assertEqual(pygame.image.tobytes(baked, 'RGB'), pygame.image.tobytes(loaded, 'RGB'))
+
+    def testSounds(self):
+        self.assertIn('punch.wav', self.pack)
+        self.assertEqual(self.pack.index['punch.wav']['kind'], 'sound')
+
+    def testStaleEntriesFallBack(self):
+        import bake_assets
+        import shutil
+        source = tempfile.TemporaryDirectory()
+        self.addCleanup(source.cleanup)
+        for name in ('chimp.bmp', 'fist.bmp'):
+            shutil.copy(os.path.join(DATA_DIR, name), source.name)
+        path = os.path.join(source.name, 'assets.pack')
+        self.assertEqual(sorted(bake_assets.bake(path, source.name)), ['chimp.bmp', 'fist.bmp'])
+        changed = os.path.join(source.name, 'fist.bmp')
+        os.utime(changed, ns=(0, os.stat(changed).st_mtime_ns + 10 ** 9))
+        pack = AssetPack(path, source.name)
+        self.addCleanup(pack.close)
+        self.assertIn('chimp.bmp', pack)
+        self.assertNotIn('fist.bmp', pack)
+        self.assertEqual(pack.stale, ['fist.bmp'])
+
+    def tearDown(self):
+        pygame.quit()
+
+
+class TestStartupProfiler(unittest.TestCase):
+    def testReport(self):
+        stream = io.StringIO()
+        profiler = profiling.install_startup_profiler(stream)
+        with profiling.startup_section('outer'):
+            with profiling.startup_section('inner'):
+                pass
+        profiling.finish_startup()
+        self.assertEqual([r[3] for r in sorted(profiler.records)], ['outer', 'inner', 'first frame presented'])
+        self.assertIn('    inner', stream.getvalue())
+        # the report is only printed once
+        profiling.finish_startup()
+        self.assertEqual(stream.getvalue().count('first frame'), 1)
+
+    def testLazyMixer(self):
+        Game(headless=True)
+        self.assertFalse(pygame.mixer.get_init())
+        self.assertTrue(init_mixer())
+        pygame.quit()
+
+
+class TestFrameProfiler(unittest.TestCase):
+    def setUp(self):
+        self.profiler = profiling.FrameProfiler(capacity=4)
+        for tick in (16, 17, 40, 16, 16, 33):
+            self.profiler.begin_frame(tick)
+            self.profiler.lap('update')
+            self.profiler.end_frame()
+
+    def testRingBuffer(self):
+        self.assertEqual(self.profiler.count, 6)
+        self.assertEqual(self.profiler.frame_numbers(), [2, 3, 4, 5])
+        self.assertEqual(self.profiler.samples('tick'), [40, 16, 16, 33])
+        self.assertEqual(self.profiler.percentiles('tick'), [33, 40, 40])
+
+    def testDroppedFrames(self):
+        self.assertEqual([frame for frame, _, _ in self.profiler.dropped], [2, 5])
+
+    def testTraceDump(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'trace.json')
+        self.profiler.dump(path)
+        with open(path) as f:
+            trace = json.load(f)
+        self.assertEqual(trace['summary']['dropped'], 2)
+        self.assertEqual([frame['dropped'] for frame in trace['frames']], [1, 0, 0, 1])
+
+    def testGameLaps(self):
+        game = Game(headless=True, profiler=self.profiler)
+        self.profiler.begin_frame(16)
+        game.step([Action.RIGHT])
+        self.profiler.end_frame()
+        self.assertGreater(self.profiler.samples('update')[-1], 0)
+        self.assertGreater(self.profiler.samples('collision')[-1], 0)
+        pygame.quit()
+
+    def testOverlayAcrossGames(self):
+        # the overlay font must not outlive the pygame.quit() between games
+        for _ in range(2):
+            profiler = profiling.FrameProfiler(overlay=True)
+            game = Game(headless=True, profiler=profiler)
+            for _ in range(3):
+                profiler.begin_frame(16)
+                game.step()
+                game.render()
+                profiler.end_frame()
+            self.assertEqual(profiler.count, 3)
+            pygame.quit()
+
+
+class TestBenchmarkBaseline(unittest.TestCase):
+    def testRegressions(self):
+        from benchmark import compare_to_baseline
+        baseline = {'load_image': 1000.0, 'game_frame_1': 60.0, 'retired': 5.0}
+        results = {'load_image': 850.0, 'game_frame_1': 40.0, 'new': 1.0}
+        self.assertEqual(compare_to_baseline(results, baseline, 0.2), ['game_frame_1'])
+        self.assertEqual(compare_to_baseline(results, baseline, 0.5), [])
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.recorder = InputRecorder()
+        self.game = Game(headless=True, recorder=self.recorder)
+        script = [([Action.RIGHT], 1), ([], 200), ([Action.JUMP], 1), ([], 30),
+                  ([Action.STOP, Action.LEFT], 3), ([Action.PAUSE], 1), ([], 10), ([Action.PAUSE], 1), ([], 500)]
+        for actions, n in script:
+            self.game.step(actions, n)
+
+    def testCompactStream(self):
+        data = self.recorder.to_bytes()
+        self.assertEqual(self.recorder.frames, 747)
+        self.assertLess(len(data), 32)
+
+    def testReplayReproducesSession(self):
+        expected = self.game.snapshot()
+        pygame.quit()
+        game = Game(headless=True)
+        ReplayDriver(self.recorder.to_bytes()).play(game)
+        self.assertEqual(game.snapshot(), expected)
+
+    def testManyActionsInOneFrame(self):
+        recorder = InputRecorder()
+        actions = [Action.RIGHT, Action.STOP] * 200
+        recorder.record(actions, 2)
+        self.assertEqual(list(ReplayDriver(recorder.to_bytes())), [(0, actions), (1, [])])
+
+    def testReadsVersion1(self):
+        data = REPLAY_MAGIC + bytes([1, 5, 1, Action.RIGHT.value, 7, 0])
+        self.assertEqual(list(ReplayDriver(data)), [(5, [Action.RIGHT]), (7, [])])
+
+    def testRejectsOtherFiles(self):
+        with self.assertRaises(ValueError):
+            ReplayDriver(b'PNG\x00\x00')
+        with self.assertRaises(ValueError):
+            ReplayDriver(REPLAY_MAGIC)
+        with self.assertRaisesRegex(ValueError, 'version 3'):
+            ReplayDriver(REPLAY_MAGIC + bytes([3, 0, 0]))
+
+    def testRejectsTruncatedStream(self):
+        data = self.recorder.to_bytes()
+        for end in (len(REPLAY_MAGIC) + 1, len(data) - 1):
+            with self.assertRaises(ValueError):
+                list(ReplayDriver(data[:end]))
+        with self.assertRaises(ValueError):
+            list(ReplayDriver(REPLAY_MAGIC + bytes([1, 5])))
+
+    def tearDown(self):
+        pygame.quit()
+
+
+class TestEntities(unittest.TestCase):
+    def setUp(self):
+        self.screen = pygame.display.set_mode((600, 337))
+
+    def testSlots(self):
+        block = BlockEntity((300, 210))
+        walker = CharacterEntity((50, GROUND_LEVEL))
+        for entity in (block, walker):
+            self.assertFalse(hasattr(entity, '__dict__'))
+        self.assertIs(block.image, BlockEntity((100, 210)).image)
+        self.assertIs(walker._atlas, CharacterEntity((80, GROUND_LEVEL))._atlas)
+
+    def testWalk(self):
+        walker = CharacterEntity((50, GROUND_LEVEL), direction=-1, speed=3)
+        group = EntityGroup(walker)
+        for _ in range(10):
+            group.update()
+        self.assertEqual(walker.rect.midbottom, (20, GROUND_LEVEL))
+        self.assertEqual(walker.velocity, (-3, 0))
+        self.assertEqual(len(group.draw(self.screen)), 1)
+
+    def testSharedResources(self):
+        self.assertIs(LuckyBlock().area, Mario().area)
+
+    def tearDown(self):
+        pygame.quit()
+
+
+class TestAudioManager(unittest.TestCase):
+    def setUp(self):
+        os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+        self.audio = AudioManager(voices=2)
+        if not self.audio.start():
+            self.skipTest('no audio device')
+        self.audio.preload('punch.wav', 'whiff.wav', JUMP_SOUND)
+
+    def testBankReusesSounds(self):
+        sound = self.audio.bank['punch.wav']
+        self.audio.play('punch.wav')
+        self.assertIs(self.audio.bank['punch.wav'], sound)
+
+    def testStartsOnFirstPlay(self):
+        pygame.quit()
+        audio = AudioManager()
+        audio.preload(JUMP_SOUND)
+        self.assertFalse(pygame.mixer.get_init())
+        self.assertEqual(audio.bank, {})
+        self.assertIsNotNone(audio.play(JUMP_SOUND))
+        self.assertIn(JUMP_SOUND, audio.bank)
+
+    def testVoiceStealing(self):
+        low = self.audio.play('whiff.wav', priority=0)
+        high = self.audio.play('punch.wav', priority=2)
+        self.assertIsNot(low, high)
+        # all voices busy: the low priority effect is stolen, a lower one is dropped
+        self.assertIs(self.audio.play(JUMP_SOUND, priority=1), low)
+        self.assertIsNone(self.audio.play('whiff.wav', priority=0))
+
+    def tearDown(self):
+        pygame.quit()
+
+
+class TestCamera(unittest.TestCase):
+    def setUp(self):
+        pygame.display.set_mode((600, 337))
+        self.camera = Camera((600, 337), margin=10)
+        self.group = CameraGroup(self.camera)
+
+    def testFollowOnlyScrollsForward(self):
+        self.assertEqual(self.camera.follow(pygame.Rect(400, 0, 10, 10)), 105)
+        self.assertEqual(self.camera.x, 105)
+        self.assertEqual(self.camera.follow(pygame.Rect(0, 0, 10, 10)), 0)
+        self.assertEqual(self.camera.x, 105)
+
+    def testCull(self):
+        near, far = LuckyBlock(), LuckyBlock()
+        far.rect.x = 2000
+        self.group.add_world(near, far)
+        self.group.cull()
+        self.assertIn(near, self.group)
+        self.assertNotIn(far, self.group)
+        self.camera.rect.x = 1800
+        self.group.cull()
+        self.assertNotIn(near, self.group)
+        self.assertIn(far, self.group)
+
+    def testDrawAtScreenOffset(self):
+        block = LuckyBlock()
+        block.rect.x = 700
+        self.group.add_world(block)
+        self.camera.rect.x = 500
+        self.group.draw(pygame.display.get_surface())
+        self.assertEqual(block.rect.x, 700)
+        self.assertEqual(self.group.spritedict[block].x, 200)
+
+    def testLayeredDirtyInternals(self):
+        # CameraGroup.draw reimplements LayeredDirty.draw on these private attributes
+        for name in ('_spritelist', '_clip', '_bgd', '_init_rect', 'spritedict', 'lostsprites'):
+            self.assertTrue(hasattr(self.group, name), name)
+        block = LuckyBlock()
+        self.group.add(block)  # not drawn yet
+        self.assertIs(self.group.spritedict[block], self.group._init_rect)
+
+    def testOffscreenSkipsUpdate(self):
+        mario = Mario(style=CharacterStyle.BIG)
+        mario.rect.x = 5000
+        self.group.add_world(mario, dynamic=True)
+        tick = mario._anim_tick
+        self.group.update()
+        self.assertEqual(mario._anim_tick, tick)
+        self.group.update_offscreen = True
+        self.group.update()
+        self.assertEqual(mario._anim_tick, tick + 1)
+
+    def testPinnedAlwaysUpdates(self):
+        mario = Mario(style=CharacterStyle.BIG)
+        mario.rect.bottom = -500
+        self.group.add_world(mario, dynamic=True, pinned=True)
+        self.group.update()
+        self.assertNotIn(mario, self.group)
+        self.assertEqual(mario.velocity[1], GRAVITY)
+
+    def tearDown(self):
+        pygame.quit()
+
+
+class TestTileLevel(unittest.TestCase):
+    def setUp(self):
+        pygame.display.set_mode((600, 337))
+        self.tmp = tempfile.TemporaryDirectory()
+        rows = ['........#...',
+                '############']
+        objects = [{'type': 'lucky_block', 'midbottom': [100, 0]},
+                   {'type': 'lucky_block', 'midbottom': [300, 0]}]
+        self.assertEqual(save_level(self.tmp.name, rows, objects, tile_size=32, chunk_tiles=4, origin_y=100,
+                                    start=(50, 132)), 3)
+        self.level = TileLevel(self.tmp.name, ahead=0)
+
+    def testChunkFiles(self):
+        chunk = self.level.load_chunk(2)
+        self.assertEqual(chunk.rect, pygame.Rect(256, 100, 128, 64))
+        self.assertEqual(chunk.rows, ['#...', '####'])
+        self.assertEqual(self.level.load_chunk(0).objects, [{'type': 'lucky_block', 'midbottom': [100, 0]}])
+        self.assertEqual(self.level.width, 384)
+
+    def testObjectOutsideLevel(self):
+        with self.assertRaises(ValueError):
+            save_level(self.tmp.name, ['####'], [{'type': 'lucky_block', 'midbottom': [128, 0]}],
+                       tile_size=32, chunk_tiles=4)
+
+    def testQuery(self):
+        self.level.stream(pygame.Rect(0, 0, 384, 10))
+        tiles = self.level.solids(pygame.Rect(250, 120, 20, 10))
+        self.assertEqual([t.rect for t in tiles], [pygame.Rect(256, 100, 32, 32)])
+        tiles = self.level.solids(pygame.Rect(0, 150, 70, 10))
+        self.assertEqual([t.rect.x for t in tiles], [0, 32, 64])
+        self.assertEqual(self.level.solids(pygame.Rect(0, 0, 384, 100)), [])
+
+    def testStream(self):
+        loaded, unloaded = self.level.stream(pygame.Rect(0, 0, 200, 10))
+        self.assertEqual([c.index for c in loaded], [0, 1])
+        self.assertEqual(unloaded, [])
+        loaded, unloaded = self.level.stream(pygame.Rect(260, 0, 100, 10))
+        self.assertEqual([c.index for c in loaded], [2])
+        self.assertEqual([c.index for c in unloaded], [0, 1])
+        self.assertEqual(list(self.level.chunks), [2])
+        # unloaded chunks report no solids
+        self.assertEqual(self.level.solids(pygame.Rect(0, 150, 70, 10)), [])
+
+    def testGameLevel(self):
+        pygame.quit()
+        game = Game(headless=True, level=self.tmp.name)
+        self.assertEqual([o.rect.midbottom for o in game.level_objects(LuckyBlock)], [(100, 0), (300, 0)])
+        game.step([Action.RIGHT], 100)
+        # stands on the ground row and is stopped by the wall tile
+        self.assertEqual(game.mario.rect.bottom, 132)
+        self.assertLessEqual(game.mario.rect.right, 256)
+        self.assertGreater(game.mario.rect.right, 250)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        pygame.quit()
+
+
+class TestBatch(unittest.TestCase):
+    def testRandomScript(self):
+        script = batch.random_script(3, 500)
+        self.assertEqual(sum(n for _, n in script), 500)
+        self.assertEqual(script, batch.random_script(3, 500))
+        self.assertNotEqual(script, batch.random_script(4, 500))
+
+    def testSweep(self):
+        jobs = list(batch.sweep(seeds=(0, 1), frames=10, running_speed=(3, 4), gravity=(1, 2)))
+        self.assertEqual(len(jobs), 8)
+        self.assertIn({'seed': 1, 'frames': 10, 'running_speed': 4, 'gravity': 1}, jobs)
+
+    def testSimulate(self):
+        result = batch.simulate({'seed': 0, 'frames': 300, 'running_speed': 0})
+        self.assertEqual(result['frames'], 300)
+        self.assertEqual(result['position'][0], 50)
+        self.assertEqual(result, batch.simulate({'seed': 0, 'frames': 300, 'running_speed': 0}))
+
+    def testParallelMatchesSerial(self):
+        jobs = list(batch.sweep(seeds=(0, 1), frames=200, jumping_speed=(15, 25)))
+        self.assertEqual(batch.run_batch(jobs, workers=2), batch.run_batch(jobs, workers=1))
+
+    def tearDown(self):
+        pygame.quit()
+
+
+class TestInputMap(unittest.TestCase):
+    def setUp(self):
+        pygame.display.set_mode((600, 337))
+        self.input = InputMap(KEY_BINDINGS, HELD_KEYS, release=Action.STOP)
+
+    @staticmethod
+    def key(event_type, key):
+        return pygame.event.Event(event_type, key=key)
+
+    def testDispatch(self):
+        events = [pygame.event.Event(pygame.QUIT), self.key(pygame.KEYDOWN, pygame.K_UP),
+                  self.key(pygame.KEYDOWN, pygame.K_a), self.key(pygame.KEYUP, pygame.K_UP),
+                  pygame.event.Event(pygame.MOUSEMOTION)]
+        self.assertEqual(self.input.actions(events), [Action.QUIT, Action.JUMP])
+
+    def testReleaseWithOtherKeyHeld(self):
+        held = {pygame.K_RIGHT: False, pygame.K_LEFT: True}
+        events = [self.key(pygame.KEYUP, pygame.K_RIGHT)]
+        self.assertEqual(self.input.actions(events, held), [Action.LEFT])
+        held[pygame.K_LEFT] = False
+        self.assertEqual(self.input.actions(events, held), [Action.STOP])
+
+    def testAllowEvents(self):
+        pygame.event.post(self.key(pygame.KEYDOWN, pygame.K_UP))
+        self.input.allow_events()
+        try:
+            self.assertTrue(pygame.event.get_blocked(pygame.MOUSEMOTION))
+            self.assertFalse(pygame.event.get_blocked(pygame.KEYUP))
+            self.assertFalse(pygame.event.get_blocked(pygame.QUIT))
+            self.assertEqual(self.input.actions(pygame.event.get()), [Action.JUMP])
+        finally:
+            pygame.event.set_allowed(None)
+
+    def tearDown(self):
+        pygame.quit()
+
+
+class _CountingScene(Scene):
+    def __init__(self, stop_after=None):
+        self.updates = 0
+        self.alphas = []
+        self.stop_after = stop_after
+
+    def update(self):
+        self.updates += 1
+        if self.updates == self.stop_after:
+            self.running = False
+
+    def draw(self, alpha):
+        self.alphas.append(alpha)
+
+
+class TestGameLoop(unittest.TestCase):
+    def setUp(self):
+        pygame.display.set_mode((600, 337))
+
+    def testFixedTimestep(self):
+        scene = _CountingScene()
+        loop = GameLoop(scene, step_rate=100)
+        loop.tick(25)
+        self.assertEqual(scene.updates, 2)
+        self.assertAlmostEqual(scene.alphas[-1], 0.5)
+        loop.tick(5)
+        self.assertEqual(scene.updates, 3)
+        self.assertAlmostEqual(scene.alphas[-1], 0.0)
+        loop.tick(4)
+        self.assertEqual(scene.updates, 3)
+        self.assertEqual(len(scene.alphas), 3)
+
+    def testCatchUpIsBounded(self):
+        scene = _CountingScene()
+        GameLoop(scene, step_rate=100, max_steps=5).tick(1000)
+        self.assertEqual(scene.updates, 5)
+
+    def testStops(self):
+        scene = _CountingScene(stop_after=2)
+        GameLoop(scene, step_rate=100).tick(50)
+        self.assertEqual(scene.updates, 2)
+        self.assertEqual(scene.alphas, [])
+
+    def testGameScene(self):
+        pygame.quit()
+        game = Game(headless=True)
+        loop = GameLoop(game)
+        pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_RIGHT))
+        loop.tick(1000 / 60)
+        self.assertEqual(game.frame, 1)
+        self.assertEqual(game.mario.state, CharacterState.RUNNING)
+        pygame.event.post(pygame.event.Event(pygame.QUIT))
+        loop.tick(1000 / 60)
+        self.assertFalse(game.running)
+
+    def testInterpolatedDraw(self):
+        camera = Camera((600, 337))
+        group = CameraGroup(camera)
+        block = LuckyBlock()
+        group.add_world(block, dynamic=True)
+        group.update()
+        block.rect.x += 10
+        group.draw(pygame.display.get_surface(), alpha=0.0)
+        self.assertEqual(group.spritedict[block].x, block.rect.x - 10)
+        group.draw(pygame.display.get_surface(), alpha=0.5)
+        self.assertEqual(group.spritedict[block].x, block.rect.x - 5)
+
+    def tearDown(self):
+        pygame.quit()
+
+
+class TestCollisionMasks(unittest.TestCase):
+    def setUp(self):
+        pygame.display.set_mode((600, 337))
+        self.mario = Mario((100, 200))
+
+    def testMasksCachedPerFrame(self):
+        atlas = self.mario._atlas
+        for frames in atlas.frames:
+            for state_frames in frames.values():
+                for frame in state_frames:
+                    self.assertEqual(atlas.masks[frame].get_size(), frame.get_size())
+        mask = self.mario.mask
+        self.mario.direction = -1
+        self.assertIsNot(self.mario.mask, mask)
+        self.mario.direction = 1
+        self.assertIs(self.mario.mask, mask)
+
+    def testTransparentCornerDoesNotCollide(self):
+        corner = SolidTile(pygame.Rect(self.mario.rect.topleft, (1, 1)))
+        self.assertFalse(self.mario.mask.get_at((0, 0)))
+        self.assertFalse(pixels_overlap(self.mario, corner))
+        x, y = self.mario.mask.centroid()
+        body = SolidTile(pygame.Rect(self.mario.rect.x + x, self.mario.rect.y + y, 1, 1))
+        self.assertTrue(pixels_overlap(body, self.mario))
+
+    def testMaskAgainstMask(self):
+        block = LuckyBlock()
+        block.rect.bottomright = self.mario.rect.move(1, 1).topleft
+        self.assertTrue(self.mario.rect.colliderect(block.rect))
+        self.assertFalse(pixels_overlap(self.mario, block))
+        block.rect.center = self.mario.rect.center
+        self.assertTrue(pixels_overlap(self.mario, block))
+
+    def tearDown(self):
+        pygame.quit()
+
+
+class TestCharacterPool(unittest.TestCase):
+    def setUp(self):
+        pygame.display.set_mode((600, 337))
+
+    def testRecycles(self):
+        pool = CharacterPool(size=2)
+        group = pygame.sprite.Group()
+        first = pool.spawn((100, GROUND_LEVEL))
+        group.add(first)
+        first.run(1)
+        first.update()
+        pool.despawn(first)
+        self.assertNotIn(first, group)
+        again = pool.spawn((200, GROUND_LEVEL), -1)
+        self.assertIs(again, first)
+        self.assertEqual(again.rect.midbottom, (200, GROUND_LEVEL))
+        self.assertEqual(list(again.velocity), [0, 0])
+        self.assertEqual(again.state, CharacterState.STOPPED)
+        self.assertEqual(again.direction, -1)
+        pool.spawn((0, 0))
+        pool.spawn((0, 0))
+        self.assertEqual(pool.created, 3)
+        self.assertEqual(len(pool), 3)
+
+    def testSharedFrames(self):
+        pool = CharacterPool(CharacterStyle.FIRE, size=2)
+        a, b = pool.spawn((0, 0)), pool.spawn((0, 0))
+        self.assertIs(a._atlas, b._atlas)
+        self.assertIsNot(a._atlas, FrameAtlas.for_style(CharacterStyle.BIG))
+
+    def testFireTint(self):
+        big = FrameAtlas.for_style(CharacterStyle.BIG).frames[0][CharacterState.STOPPED][0]
+        fire = FrameAtlas.for_style(CharacterStyle.FIRE).frames[0][CharacterState.STOPPED][0]
+        self.assertEqual(fire.get_size(), big.get_size())
+        self.assertEqual(pygame.mask.from_surface(fire).count(), pygame.mask.from_surface(big).count())
+        self.assertNotEqual(pygame.image.tobytes(fire, 'RGB'), pygame.image.tobytes(big, 'RGB'))
+
+    def testBatchMembership(self):
+        batch = PhysicsBatch()
+        pool = CharacterPool(batch=batch)
+        sprite = pool.spawn((100, GROUND_LEVEL - 50))
+        self.assertEqual(len(batch), 1)
+        batch.step()
+        self.assertEqual(sprite.velocity[1], GRAVITY)
+        pool.despawn(sprite)
+        self.assertEqual(len(batch), 0)
+        self.assertIsNone(sprite._batch)
+
+    def testStressScene(self):
+        scene = StressScene(50)
+        reserved = sum(pool.created for pool in scene.pools)
+        self.assertEqual(reserved, 50)
+        for _ in range(2000):
+            scene.update()
+        scene.draw(1.0)
+        self.assertLessEqual(len(scene.batch), 50)
+        self.assertGreaterEqual(len(scene.batch), 40)
+        self.assertEqual(sum(pool.created for pool in scene.pools), reserved)
+
+    def testStressSceneRenderModes(self):
+        # dirty rects and full flips must leave the same picture behind
+        screens = []
+        for mode in (RenderMode.DIRTY, RenderMode.FLIP):
+            scene = StressScene(20, render_mode=mode)
+            for _ in range(30):
+                scene.update()
+                scene.draw(1.0)
+            screens.append(pygame.image.tobytes(scene.screen, 'RGB'))
+        self.assertEqual(screens[0], screens[1])
+
+    def tearDown(self):
+        pygame.quit()
+
+
+class TestSpatialHash(unittest.TestCase):
+    class Block:
+        def __init__(self, *rect):
+            self.rect = pygame.Rect(rect)
+
+    def setUp(self):
+        self.grid = SpatialHash(cell_size=32)
+        self.near = self.Block(10, 10, 20, 20)
+        self.far = self.Block(500, 10, 20, 20)
+        self.grid.insert(self.near)
+        self.grid.insert(self.far)
+
+    def testQuery(self):
+        self.assertEqual(self.grid.query(pygame.Rect(0, 0, 40, 40)), [self.near])
+        self.assertEqual(self.grid.query(pygame.Rect(0, 0, 600, 40)), [self.near, self.far])
+
+    def testMove(self):
+        self.far.rect.x = 20
+        self.grid.move(self.far)
+        self.assertEqual(self.grid.query(pygame.Rect(0, 0, 40, 40)), [self.near, self.far])
+        self.grid.remove(self.near)
+        self.assertEqual(self.grid.query(pygame.Rect(0, 0, 40, 40)), [self.far])
+
+    def testPan(self):
+        for block in (self.near, self.far):
+            block.rect.move_ip(-480, 0)
+        self.grid.pan(-480)
+        self.assertEqual(self.grid.query(pygame.Rect(0, 0, 40, 40)), [self.far])
+
+
+class TestGameHeadless(unittest.TestCase):
+    def setUp(self):
+        self.game = Game(headless=True)
+
+    def testStep(self):
+        x = self.game.mario.rect.x
+        self.assertEqual(self.game.step([Action.RIGHT], 10), 10)
+        self.assertGreater(self.game.mario.rect.x, x)
+        self.assertEqual(self.game.mario.state, CharacterState.RUNNING)
+
+    def testLandsOnLuckyBlock(self):
+        block = self.game.level_objects(LuckyBlock)[0].rect
+        self.game.mario.rect.midbottom = (block.centerx, block.top - 40)
+        self.game.step([], 30)
+        self.assertEqual(self.game.mario.rect.bottom, block.top)
+
+    def testJumpIntoBlockAtAngle(self):
+        # the rects overlap through transparent corners before any pixels touch;
+        # that must not count as entering the block sideways
+        block = self.game.level_objects(LuckyBlock)[0].rect
+        mario = self.game.mario
+        mario.rect.midbottom = (block.left, GROUND_LEVEL)
+        self.game.step([Action.LEFT])
+        self.game.step([Action.JUMP])
+        for _ in range(40):
+            x = mario.rect.x
+            self.game.step()
+            self.assertLess(abs(mario.rect.x - x), block.width // 2)
+        self.assertLess(mario.rect.right, block.centerx)
+
+    def testRestoresVideoDriver(self):
+        pygame.quit()
+        previous = os.environ.get('SDL_VIDEODRIVER')
+        os.environ['SDL_VIDEODRIVER'] = 'offscreen'
+        try:
+            self.game = Game(headless=True)
+            self.assertEqual(pygame.display.get_driver(), 'dummy')
+            self.assertEqual(os.environ['SDL_VIDEODRIVER'], 'offscreen')
+        finally:
+            if previous is None:
+                del os.environ['SDL_VIDEODRIVER']
+            else:
+                os.environ['SDL_VIDEODRIVER'] = previous
+
+    def testPauseStopsSimulation(self):
+        self.game.step([Action.PAUSE], 10)
+        self.assertEqual(self.game.frame, 0)
+
+    def testDeterministic(self):
+        inputs = [([Action.RIGHT], 30), ([Action.JUMP], 40), ([Action.STOP], 5), ([Action.LEFT], 50)]
+        for actions, n in inputs:
+            self.game.step(actions, n)
+        first = self.game.snapshot()
+        pygame.quit()
+        self.game = Game(headless=True)
+        for actions, n in inputs:
+            self.game.step(actions, n)
+        self.assertEqual(first, self.game.snapshot())
+
+    def tearDown(self):
+        pygame.quit()
+
 if __name__ == '__main__':
     unittest.main()
 